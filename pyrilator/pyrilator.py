@@ -6,12 +6,20 @@ What happens in the background:
 * Heavy user of verilator
 * verilator generates build/Vmodule.h with the raw verilog module's ports
     * Unfortunatelly this is a C++ file that's hard to use from python
-* Regex those ports to decode their names and types
+* Regex those ports to decode their names and types, and the verilog
+  source to know which ones are signed
 * Generate a wrapper full of getters, setters and the eval function and
   put the wrappers inside an `extern "C"`
-* Compile wrapper and all the other verilator libraries into build/module.so
-* Together with some remembered prototype cdefs from the generated wrapper,
-  load **module.so** using python's cffi.
+* Compile the verilator runtime once into build/libverilated-*.so, link
+  the wrapper and verilated model against it into a cffi API mode
+  extension build/_pyrilated_module*.so, whose calls release the GIL
+* All of the above is cached by content hash, an unchanged module doesn't
+  run verilator or g++ at all
+* Every instance counts its evals, clock cycles and time spent in C, see
+  stats(). Waveform tracing is opt-in, pyrilate(..., trace="fst"), and
+  without it no tracing code is built at all
+* Import **_pyrilated_module*.so**, its ffi and lib are the wrapper's
+  prototypes as python functions.
 * Pythonize the resulting c functions into a class, every port is a python
   property that calls the setters and getters in the background
 
@@ -26,39 +34,145 @@ Example:
 """
 
 import cffi
+import contextlib
+import fcntl
+import hashlib
+import importlib.util
+import itertools
+import json
+import numpy
+import os
 from pathlib import Path
 import pprint
 import re
+import shutil
 import subprocess
+import sysconfig
+import tempfile
+import time
 
 VFLAGS = [ # TODO: add this to pyrilate arguments
     # "-Wall", # TODO: fix lms.sv so it doesn't need it
     "-Wno-WIDTH", # These are inane, something as simple as (var == 25) ? : will warn with this on
 ]
+VERILATOR_INCLUDE = Path("/usr/share/verilator/include")
 VERILATOR_SOURCES = [
-    "/usr/share/verilator/include/verilated.cpp",
-    "/usr/share/verilator/include/verilated_threads.cpp",
+    VERILATOR_INCLUDE/"verilated.cpp",
+    VERILATOR_INCLUDE/"verilated_threads.cpp",
 ]
+CLOCK = "clk" # rising edges of this port count as cycles
+
+# trace format: verilator flag, writer class, extra libraries
+TRACE_FORMATS = {
+    "vcd": ("--trace", "VerilatedVcdC", []),
+    "fst": ("--trace-fst", "VerilatedFstC", ["z"]),
+}
 
 C_TEMPLATE = """// Automatically generated by pyrilator
+#include <chrono>
 #include "string.h"
 #include "verilated.h"
+{trace_include}
 #include "V{sv_module}.h"
 
 extern "C" {{
 H_CONTENTS
 
+// the model plus what else an instance needs, handed out as a V{sv_module} *
+struct {sv_module}_tb : V{sv_module} {{
+	{sv_module}_stats stats = {{}};
+	unsigned char last_clock = 0;
+{trace_member}
+	{sv_module}_tb(VerilatedContext *contextp) : V{sv_module}(contextp, "TOP") {{}}
+
+	void step() {{
+		eval();
+		stats.evals++;
+{clock_count}
+{trace_dump}
+	}}
+}};
+
+static {sv_module}_tb *{sv_module}_tb_cast(void *tb) {{
+	return static_cast<{sv_module}_tb *>((V{sv_module} *)tb);
+}}
+
+static unsigned long long {sv_module}_now_ns() {{
+	return std::chrono::duration_cast<std::chrono::nanoseconds>(
+		std::chrono::steady_clock::now().time_since_epoch()).count();
+}}
+
 void *{sv_module}_new(int argc, char **argv) {{ //def
-	Verilated::commandArgs(argc, argv);
-	return (void *)new V{sv_module};
+	// every instance gets its own context, so they can run in parallel
+	VerilatedContext *contextp = new VerilatedContext;
+	contextp->commandArgs(argc, argv);
+{context_setup}
+	return (void *)(V{sv_module} *)new {sv_module}_tb(contextp);
+}}
+
+void {sv_module}_delete(void *tb) {{ //def
+	// the model has to go before the context it was made with
+	{sv_module}_tb *t = {sv_module}_tb_cast(tb);
+	VerilatedContext *contextp = t->contextp();
+	t->final();
+	delete t;
+	delete contextp;
 }}
 
 void {sv_module}_eval(void *tb) {{ //def
-	((V{sv_module} *)tb)->eval();
+	{sv_module}_tb *t = {sv_module}_tb_cast(tb);
+	unsigned long long start = {sv_module}_now_ns();
+	t->step();
+	t->stats.c_ns += {sv_module}_now_ns() - start;
+}}
+
+void {sv_module}_read_stats(void *tb, {sv_module}_stats *s, int reset) {{ //def
+	{sv_module}_tb *t = {sv_module}_tb_cast(tb);
+	*s = t->stats;
+	if (reset)
+		t->stats = {{}};
 }}
 
 {arg_function_contents}
 
+static void {sv_module}_set_port(V{sv_module} *dut, int port, long long v) {{
+	switch (port) {{
+{set_port_cases}
+	}}
+}}
+
+// writes the port's value, or every element of an array port, to out
+static int {sv_module}_read_port(V{sv_module} *dut, int port, long long *out) {{
+	switch (port) {{
+{read_port_cases}
+	}}
+	return 0;
+}}
+
+void {sv_module}_snapshot(void *tb, {sv_module}_ports *s) {{ //def
+{snapshot_lines}
+}}
+
+void {sv_module}_apply(void *tb, const {sv_module}_ports *s) {{ //def
+{apply_lines}
+}}
+
+void {sv_module}_run_cycles(void *tb, unsigned int cycles, int clock, int n_inputs, const int *input_ports, const long long *inputs, int n_outputs, const int *output_ports, long long *outputs) {{ //def
+	{sv_module}_tb *dut = {sv_module}_tb_cast(tb);
+	unsigned long long start = {sv_module}_now_ns();
+	for (unsigned int c = 0; c < cycles; c++) {{
+		for (int i = 0; i < n_inputs; i++)
+			{sv_module}_set_port(dut, input_ports[i], inputs[c * n_inputs + i]);
+		{sv_module}_set_port(dut, clock, 0);
+		dut->step();
+		for (int i = 0; i < n_outputs; i++)
+			outputs += {sv_module}_read_port(dut, output_ports[i], outputs);
+		{sv_module}_set_port(dut, clock, 1);
+		dut->step();
+	}}
+	dut->stats.c_ns += {sv_module}_now_ns() - start;
+}}
+
 }}
 """
 
@@ -72,6 +186,35 @@ SETTER_TEMPLATE = """void {sv_module}_set_{arg_name}(void *tb, {type} v{array_si
 }}
 """
 
+# only built with trace=, tracing starts when the instance opens its file
+TRACE_TEMPLATE = """void {sv_module}_trace_open(void *tb, const char *filename) {{ //def
+	{sv_module}_tb *t = {sv_module}_tb_cast(tb);
+	t->tfp = new {trace_class};
+	t->trace(t->tfp, 99);
+	t->tfp->open(filename);
+}}
+
+void {sv_module}_trace_close(void *tb) {{ //def
+	{sv_module}_tb *t = {sv_module}_tb_cast(tb);
+	if (t->tfp) {{
+		t->tfp->close();
+		delete t->tfp;
+		t->tfp = nullptr;
+	}}
+}}
+"""
+
+# verilator keeps signed ports unsigned, these sign extend from the port's msb
+SIGNED_GETTER_TEMPLATE = """{signed_type} {sv_module}_get_{arg_name}(void *tb) {{ //def
+	return (({signed_type})(({type})(((V{sv_module} *)tb)->{arg_name} << {shift}))) >> {shift};
+}}
+"""
+
+SIGNED_SETTER_TEMPLATE = """void {sv_module}_set_{arg_name}(void *tb, {signed_type} v) {{ //def
+	((V{sv_module} *)tb)->{arg_name} = v & {mask:#x}ULL;
+}}
+"""
+
 # See verilated_types.h
 SIZE_MAPPING = {
     "8": "unsigned char",
@@ -79,6 +222,18 @@ SIZE_MAPPING = {
     "": "unsigned int",
     "64": "unsigned long long int",
 }
+SIGNED_SIZE_MAPPING = {
+    "8": "signed char",
+    "16": "short int",
+    "": "int",
+    "64": "long long int",
+}
+STORAGE_BITS = {
+    "8": 8,
+    "16": 16,
+    "": 32,
+    "64": 64,
+}
 
 ARGUMENT_RE = re.compile(r"""
     VL_(?P<dir>IN|OUT)(?P<size>[0-9]*)
@@ -92,133 +247,501 @@ ARGUMENT_RE = re.compile(r"""
         \);
     """, re.VERBOSE)
 
-def compile(sv_file:Path, build_dir):
-    sv_module = sv_file.stem
-    build_dir = Path(build_dir).resolve()
-
-    subprocess.check_call([
-        "verilator",
-        *VFLAGS,
-        "-cc", sv_file,
-        "--Mdir", str(build_dir),
-        "--build",
-        "-CFLAGS", "-fPIC",
-    ])
-
-    verilated_header_contents = (build_dir/f"V{sv_module}.h").read_text()
-    arg_functions = []
-    args = {}
-    for argument in ARGUMENT_RE.finditer(verilated_header_contents):
-        a = argument.groupdict()
-
-        if a["var"] is not None:
-            arg_name = a["var"]
-            array_size = ""
-            ret_pointer = ""
-            memcpy_ref = "&"
-        elif a["array"] is not None:
-            arg_name = a["array"]
-            array_size = "[" + a["array_size"] + "]"
-            ret_pointer = "*"
-            memcpy_ref = ""
-
-        template = GETTER_TEMPLATE
-        if "IN" in a["dir"]:
-            template += SETTER_TEMPLATE
-
-        f = template.format(
-            type = SIZE_MAPPING[a['size']],
-            **locals()
-        )
-        arg_functions.append(f)
-        args[arg_name] = a
-
-    arg_function_contents='\n'.join(arg_functions)
-    c_contents = C_TEMPLATE.format(**locals())
-
-    arg_prototypes = []
-    for line in c_contents.split("\n"):
-        if line.endswith("//def"):
-            arg_prototypes.append(
-                line.removesuffix(" { //def")
-                + ";"
-            )
-    h_contents = '\n'.join(arg_prototypes)
-    c_contents = c_contents.replace("H_CONTENTS", h_contents)
-
-    cpp_file = build_dir/f"{sv_module}.pyrilated.cpp"
-    with open(cpp_file, "w") as f:
-        f.write(c_contents)
-
-    h_file = build_dir/f"{sv_module}.pyrilated.h"
-    with open(h_file, "w") as f:
-        f.write(h_contents)
-
-    with open((build_dir/f"{sv_module}.h"), "w") as f:
-        f.write(h_contents)
-
-    so_file = build_dir/f"{sv_module}.so"
+# just enough of a verilog port declaration to know if it's signed
+PORT_RE = re.compile(r"""
+    \b(?:input|output|inout)\s+
+    (?:(?:wire|reg|logic)\s+)?
+    (?P<signed>signed\s+)?
+    (?:\[[^\]]*\]\s*)?
+    (?P<name>\w+)
+    """, re.VERBOSE)
 
-    # TODO: cache this somehow, ala how a makefile does it
+def signed_ports(sv_file:Path):
+    """Names of the ports declared signed in sv_file."""
+    return {
+        port["name"]
+        for port in PORT_RE.finditer(sv_file.read_text())
+        if port["signed"]
+    }
+
+def port_dtype(arg):
+    """numpy dtype matching how verilator stores a port. Signed only if
+    the port fills its storage, otherwise it needs sign extension."""
+    bits = STORAGE_BITS[arg["size"]]
+    signed = arg["signed"] and int(arg["msb"]) - int(arg["lsb"]) + 1 == bits
+    return numpy.dtype(f"{'i' if signed else 'u'}{bits // 8}")
+
+def verilator_version():
+    """Version of the installed verilator, without having to run it."""
+    return (VERILATOR_INCLUDE/"verilated_config.h").read_text()
+
+def content_hash(*parts):
+    h = hashlib.sha256()
+    for part in parts:
+        h.update(part if isinstance(part, bytes) else repr(part).encode())
+    return h.hexdigest()
+
+def atomic_write(path:Path, contents:str):
+    """Write a file so concurrent readers see either the old or new one."""
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    tmp.write_text(contents)
+    os.replace(tmp, path)
+
+@contextlib.contextmanager
+def build_lock(lock_file:Path):
+    """Hold an exclusive lock on lock_file, so only one process at a
+    time verilates and links into the same build directory."""
+    with open(lock_file, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def compile_runtime(build_dir:Path):
+    """Build the verilator runtime once into a shared object for all the
+    pyrilated modules to link against, instead of compiling it into each."""
+    version = content_hash(verilator_version(), *(f.read_bytes() for f in VERILATOR_SOURCES))
+    so_file = build_dir/f"libverilated-{version[:16]}.so"
+    if so_file.exists():
+        return so_file
+
+    tmp = so_file.with_name(f"{so_file.name}.{os.getpid()}.tmp")
     subprocess.check_call([
         "g++",
         "-fPIC",
-        "-I", "/usr/share/verilator/include",
-        "-I", str(build_dir),
-        *VERILATOR_SOURCES,
-        "-Wall",
-        str(cpp_file),
-        str(build_dir/f"V{sv_module}__ALL.a"),
-
+        "-I", str(VERILATOR_INCLUDE),
+        *map(str, VERILATOR_SOURCES),
+        "-pthread",
         "--shared",
-        "-o", str(so_file),
+        "-Wl,-soname," + so_file.name,
+        "-o", str(tmp),
     ])
+    os.replace(tmp, so_file)
+    return so_file
+
+def compile(sv_file:Path, build_dir, threads=None, trace=None, parameters=None):
+    """Verilate sv_file and build its pyrilated wrapper into build_dir.
+
+    The wrapper is a cffi API mode extension, so its calls release the
+    GIL. threads is passed on to verilator --threads, trace is one of
+    TRACE_FORMATS and parameters overrides the top module's parameters,
+    as a dict of names to values. Builds with any of those get their
+    own subdirectory of build_dir.
+
+    Everything is cached by content hash: if the verilog sources next
+    to sv_file, VFLAGS, verilator version and pyrilator's templates
+    didn't change, neither verilator nor g++ run at all. If they did,
+    g++ only links again when the generated wrapper or model changed.
+    Processes building the same module and variant take turns, see
+    build_lock()."""
+    sv_module = sv_file.stem
+    runtime_dir = Path(build_dir).resolve()
+
+    vflags = list(VFLAGS)
+    variant = ""
+    context_setup = ""
+    if threads:
+        vflags += ["--threads", str(threads)]
+        variant += f"_threads{threads}"
+        context_setup += f"\tcontextp->threads({threads});"
+
+    for name, value in (parameters or {}).items():
+        vflags += [f"-G{name}={value}"]
+        variant += f"_{name}{value}"
+
+    trace_include = trace_member = trace_dump = ""
+    trace_sources = []
+    trace_libraries = []
+    if trace:
+        assert trace in TRACE_FORMATS, f"trace has to be one of {list(TRACE_FORMATS)}"
+        trace_flag, trace_class, trace_libraries = TRACE_FORMATS[trace]
+        vflags += [trace_flag]
+        variant += f"_trace_{trace}"
+        context_setup += "\n\tcontextp->traceEverOn(true);"
+        trace_include = f'#include "verilated_{trace}_c.h"'
+        trace_member = f"\t{trace_class} *tfp = nullptr;"
+        trace_dump = "\t\tif (tfp) {\n\t\t\ttfp->dump(contextp()->time());\n\t\t\tcontextp()->timeInc(1);\n\t\t}"
+        trace_sources = [VERILATOR_INCLUDE/f"verilated_{trace}_c.cpp"]
+
+    build_dir = runtime_dir/f"{sv_module}{variant}" if variant else runtime_dir
+    build_dir.mkdir(exist_ok=True)
+
+    module_name = f"_pyrilated_{sv_module}{variant}"
+    h_file = build_dir/f"{sv_module}.pyrilated.h"
+    so_file = build_dir/(module_name + sysconfig.get_config_var("EXT_SUFFIX"))
+    manifest_file = build_dir/f"{sv_module}.pyrilated.json"
+
+    sources_key = content_hash(
+        sv_file.name,
+        *(f.read_bytes() for f in sorted(sv_file.parent.glob("*.sv"))),
+        vflags,
+        verilator_version(),
+        Path(__file__).read_bytes(), # any change to the generated wrapper
+    )
+    # another process with a cold cache may be building the same variant
+    with build_lock(build_dir/f"{sv_module}.pyrilated.lock"):
+        try:
+            manifest = json.loads(manifest_file.read_text())
+        except (FileNotFoundError, ValueError):
+            manifest = {}
+        if manifest.get("sources_key") == sources_key and so_file.exists() and h_file.exists():
+            return h_file, so_file, manifest["args"]
+
+        subprocess.check_call([
+            "verilator",
+            *vflags,
+            "-y", str(sv_file.parent), # submodules live next to the top one
+            "-cc", sv_file,
+            "--Mdir", str(build_dir),
+            "--build",
+            "-CFLAGS", "-fPIC",
+        ])
+
+        verilated_header_contents = (build_dir/f"V{sv_module}.h").read_text()
+        signed = signed_ports(sv_file)
+        arg_functions = []
+        struct_fields = []
+        snapshot_lines = []
+        apply_lines = []
+        set_port_cases = []
+        read_port_cases = []
+        clock_count = ""
+        args = {}
+        for argument in ARGUMENT_RE.finditer(verilated_header_contents):
+            a = argument.groupdict()
+            a["signed"] = (a["var"] or a["array"]) in signed
+            # verilator wants clean inputs, no bits set above msb
+            mask = (1 << (int(a["msb"]) + 1)) - 1
+            shift = STORAGE_BITS[a["size"]] - (int(a["msb"]) + 1)
+
+            if a["var"] is not None:
+                arg_name = a["var"]
+                array_size = ""
+                ret_pointer = ""
+                memcpy_ref = "&"
+
+                # ports get a number so run_cycles() can address them
+                a["port"] = len(read_port_cases)
+                read_port_cases.append(f"\tcase {a['port']}: out[0] = {sv_module}_get_{arg_name}(dut); return 1;")
+                if "IN" in a["dir"]:
+                    set_port_cases.append(f"\tcase {a['port']}: dut->{arg_name} = v & {mask:#x}ULL; break;")
+            elif a["array"] is not None:
+                arg_name = a["array"]
+                array_size = "[" + a["array_size"] + "]"
+                ret_pointer = "*"
+                memcpy_ref = ""
+
+                # run_cycles() can only read arrays, a whole one at once
+                a["port"] = len(read_port_cases)
+                element = f"dut->{arg_name}[i]"
+                if a["signed"]:
+                    element = f"(({SIGNED_SIZE_MAPPING[a['size']]})(({SIZE_MAPPING[a['size']]})({element} << {shift}))) >> {shift}"
+                read_port_cases.append(f"\tcase {a['port']}: for (int i = 0; i < {a['array_size']}; i++) out[i] = {element}; return {a['array_size']};")
+
+            if arg_name == CLOCK and "IN" in a["dir"]:
+                clock_count = "\t\tif ({0} && !last_clock)\n\t\t\tstats.cycles++;\n\t\tlast_clock = {0};".format(CLOCK)
+
+            if a["signed"] and a["var"] is not None:
+                template = SIGNED_GETTER_TEMPLATE
+                if "IN" in a["dir"]:
+                    template += SIGNED_SETTER_TEMPLATE
+            else:
+                template = GETTER_TEMPLATE
+                if "IN" in a["dir"]:
+                    template += SETTER_TEMPLATE
+
+            f = template.format(
+                type = SIZE_MAPPING[a['size']],
+                signed_type = SIGNED_SIZE_MAPPING[a['size']],
+                **locals()
+            )
+            arg_functions.append(f)
+
+            # one field per port in {sv_module}_ports, for snapshot() and apply()
+            if a["var"] is not None:
+                field_type = (SIGNED_SIZE_MAPPING if a["signed"] else SIZE_MAPPING)[a["size"]]
+                snapshot_lines.append(f"\ts->{arg_name} = {sv_module}_get_{arg_name}(tb);")
+                if "IN" in a["dir"]:
+                    apply_lines.append(f"\t{sv_module}_set_{arg_name}(tb, s->{arg_name});")
+            else:
+                field_type = (SIGNED_SIZE_MAPPING if port_dtype(a).kind == "i" else SIZE_MAPPING)[a["size"]]
+                snapshot_lines.append(f"\tmemcpy(s->{arg_name}, ((V{sv_module} *)tb)->{arg_name}, sizeof(s->{arg_name}));")
+                if "IN" in a["dir"]:
+                    apply_lines.append(f"\tmemcpy(((V{sv_module} *)tb)->{arg_name}, s->{arg_name}, sizeof(s->{arg_name}));")
+            struct_fields.append(f"\t{field_type} {arg_name}{array_size};")
+            args[arg_name] = a
+
+        if trace:
+            arg_functions.append(TRACE_TEMPLATE.format(**locals()))
+
+        arg_function_contents='\n'.join(arg_functions)
+        set_port_cases='\n'.join(set_port_cases)
+        read_port_cases='\n'.join(read_port_cases)
+        snapshot_lines='\n'.join(snapshot_lines)
+        apply_lines='\n'.join(apply_lines)
+        c_contents = C_TEMPLATE.format(**locals())
+
+        arg_prototypes = []
+        for line in c_contents.split("\n"):
+            if line.endswith("//def"):
+                arg_prototypes.append(
+                    line.removesuffix(" { //def")
+                    + ";"
+                )
+        h_contents = '\n'.join([
+            "typedef struct {",
+            *struct_fields,
+            f"}} {sv_module}_ports;",
+            "typedef struct {",
+            "\tunsigned long long evals;",
+            "\tunsigned long long cycles;",
+            "\tunsigned long long c_ns;",
+            f"}} {sv_module}_stats;",
+            *arg_prototypes,
+        ])
+        c_contents = c_contents.replace("H_CONTENTS", h_contents)
+
+        cpp_file = build_dir/f"{sv_module}.pyrilated.cpp"
+        atomic_write(cpp_file, c_contents)
+        atomic_write(h_file, h_contents)
+        atomic_write(build_dir/f"{sv_module}.h", h_contents)
+
+        runtime_so_file = compile_runtime(runtime_dir)
+        model_a_file = build_dir/f"V{sv_module}__ALL.a"
+        link_key = content_hash(c_contents, model_a_file.read_bytes(), runtime_so_file.name)
+
+        if manifest.get("link_key") != link_key or not so_file.exists():
+            tmpdir = tempfile.mkdtemp(prefix=module_name, dir=build_dir)
+            try:
+                builder = cffi.FFI()
+                builder.cdef(h_contents)
+                builder.set_source(
+                    module_name,
+                    f'extern "C" {{\n#include "{h_file.name}"\n}}',
+                    source_extension = ".cpp",
+                    sources = [str(cpp_file), *map(str, trace_sources)],
+                    include_dirs = [str(build_dir), str(VERILATOR_INCLUDE)],
+                    extra_objects = [str(model_a_file), str(runtime_so_file)],
+                    extra_link_args = ["-Wl,-rpath," + str(runtime_dir)],
+                    libraries = ["stdc++", *trace_libraries],
+                )
+                built = builder.compile(tmpdir=tmpdir)
+                # replacing instead of overwriting keeps already loaded copies intact
+                os.replace(built, so_file)
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors=True)
+
+        atomic_write(manifest_file, json.dumps(dict(
+            sources_key=sources_key,
+            link_key=link_key,
+            args=args,
+        ), indent=4))
+
+        return h_file, so_file, args
+
+def load_extension(so_file:Path):
+    """Import a compiled pyrilated module from its path."""
+    module_name = so_file.name.split(".")[0]
+    spec = importlib.util.spec_from_file_location(module_name, so_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+class PortMemory:
+    """An array port's memory inside a model, for numpy to view. Views
+    keep it as their base, and it keeps the instance owning the model
+    alive, so the model isn't freed from under a view."""
+    def __init__(self, owner, address, shape, dtype):
+        self.owner = owner
+        self.__array_interface__ = dict(
+            data=(address, False),
+            shape=shape,
+            typestr=dtype.str,
+            version=3,
+        )
 
-    return h_file, so_file, args
-
-def pyrilate(sv_file:Path, build_dir):
+def port_property(cls, arg_name, arg):
+    """Property for one port, calling straight into its cffi getter and
+    setter. Array ports give out numpy views straight into the model."""
+    fset = None
+
+    if arg["array_size"]:
+        dtype = port_dtype(arg)
+        shape = (int(arg["array_size"]),)
+        def fget(self):
+            return numpy.asarray(PortMemory(self, self._addresses[arg_name], shape, dtype))
+        if "IN" in arg["dir"]:
+            def fset(self, v):
+                fget(self)[:] = v
+        return property(fget, fset)
+
+    getter = getattr(cls._lib, f"{cls._sv_module}_get_{arg_name}")
+    fget = lambda self: getter(self._tb)
+    if "IN" in arg["dir"]:
+        setter = getattr(cls._lib, f"{cls._sv_module}_set_{arg_name}")
+        fset = lambda self, v: setter(self._tb, v)
+    return property(fget, fset)
+
+def pyrilate(sv_file:Path, build_dir, threads=None, trace=None, parameters=None):
+    """Class wrapping the verilog module in sv_file, see compile() for
+    the arguments. Instances are independent, each with its own verilator
+    context, and calls into them release the GIL. So running different
+    instances from different threads is parallel."""
     class Pyrilated_:
         _sv_module = sv_file.stem
+        _trace = trace
+        _instances = itertools.count()
+
+        _h_file, _so_file, _args = compile(sv_file, build_dir,
+            threads=threads, trace=trace, parameters=parameters)
+        _trace_dir = _h_file.parent # the variant's own build directory
+
+        _module = load_extension(_so_file)
+        _ffi = _module.ffi
+        _lib = _module.lib
+        _new = getattr(_lib, _sv_module+"_new")
+        _delete = getattr(_lib, _sv_module+"_delete")
+        _eval = getattr(_lib, _sv_module+"_eval")
+        _snapshot = getattr(_lib, _sv_module+"_snapshot")
+        _apply = getattr(_lib, _sv_module+"_apply")
+        _read_stats = getattr(_lib, _sv_module+"_read_stats")
+
+        def __init__(self, trace_file=None):
+            """With trace= builds, every eval is dumped to trace_file,
+            by default one numbered by process and instance in the
+            variant's build directory."""
+            self.trace_file = None
+            self._tb = self._new(0, [])
+            self._ports = self._ffi.new(f"{self._sv_module}_ports *")
+            self._stats = self._ffi.new(f"{self._sv_module}_stats *")
+            self._stats_since = time.perf_counter()
+
+            if self._trace:
+                if trace_file is None:
+                    trace_file = self._trace_dir/f"{self._sv_module}.{os.getpid()}.{next(self._instances)}.{self._trace}"
+                self.trace_file = Path(trace_file)
+                getattr(self._lib, self._sv_module+"_trace_open")(self._tb, str(self.trace_file).encode())
+
+            # where the array ports are in the model, see port_property()
+            self._addresses = {
+                arg_name: int(self._ffi.cast("uintptr_t",
+                    getattr(self._lib, self._sv_module+"_get_"+arg_name)(self._tb)))
+                for arg_name, arg in self._args.items() if arg["array_size"]
+            }
+
+        def eval(self):
+            self._eval(self._tb)
+
+        def close(self):
+            """Finish writing the trace, if any, the instance can't be
+            traced anymore afterwards."""
+            if self.trace_file is not None:
+                getattr(self._lib, self._sv_module+"_trace_close")(self._tb)
+                self.trace_file = None
+
+        def __del__(self):
+            """Free the model and its context, only once no numpy view of
+            an array port is left, see PortMemory."""
+            if getattr(self, "_tb", None) is None:
+                return
+            self.close()
+            self._delete(self._tb)
+            self._tb = None
+
+        def stats(self, reset=False):
+            """Profiling counters since the instance was made, or the
+            last stats(reset=True).
+
+            c_seconds is the time spent inside eval() and run_cycles(),
+            python_seconds is the rest of the wall time: the python glue
+            around them, plus whatever the caller did in between."""
+            self._read_stats(self._tb, self._stats, reset)
+            now = time.perf_counter()
+            wall_seconds = now - self._stats_since
+            c_seconds = self._stats.c_ns / 1e9
+            if reset:
+                self._stats_since = now
+            return dict(
+                evals=self._stats.evals,
+                cycles=self._stats.cycles,
+                wall_seconds=wall_seconds,
+                c_seconds=c_seconds,
+                python_seconds=wall_seconds - c_seconds,
+            )
 
-        _h_file, _so_file, _args = compile(sv_file, build_dir)
-
-        _ffi = cffi.FFI()
-        _ffi.cdef(_h_file.read_text())
-
-        _lib = _ffi.dlopen(str(_so_file))
-
-        def __init__(self):
-            self._tb = getattr(self._lib, self._sv_module+"_new")(0, [])
-
-            eval_f = getattr(self._lib, self._sv_module+"_eval")
-            self.eval = lambda: eval_f(self._tb)
-
-            def create_property(arg_name, array_size=None):
-                getter = getattr(self._lib, self._sv_module+"_get_"+arg_name)
-                if not array_size:
-                    fget=lambda self: getter(self._tb)
-                else: # is_array
-                    array_size = int(array_size)
-                    fget=lambda self: list(getter(self._tb)[0:array_size])
-                try:
-                    setter = getattr(self._lib, self._sv_module+"_set_"+arg_name)
-                    fset = lambda self, v: setter(self._tb, v)
-                except AttributeError:
-                    fset = None
-                return property(fget, fset)
+        def snapshot(self):
+            """Read every port in one call into C.
+
+            Returns a cffi struct with a field per port, the same one is
+            reused on every call, so copy out what needs to be kept."""
+            self._snapshot(self._tb, self._ports)
+            return self._ports
+
+        def apply(self, ports):
+            """Write every input port in one call into C.
+
+            ports is either a struct like the one from snapshot(), or a
+            dict of just the ports to change."""
+            if isinstance(ports, dict):
+                self._snapshot(self._tb, self._ports)
+                for arg_name, v in ports.items():
+                    setattr(self._ports, arg_name, v)
+                ports = self._ports
+            self._apply(self._tb, ports)
+
+        def run_cycles(self, inputs, outputs=(), clock="clk", cycles=None):
+            """Run whole clock cycles in C, without coming back to python.
+
+            inputs maps input port names to arrays with one value per
+            cycle, they're set at the start of each cycle. Every cycle
+            then sets clock low, evals, samples the outputs and finally
+            sets clock high and evals again. So outputs see the inputs
+            of their cycle, but not its rising edge yet.
+
+            Returns a dict of outputs port names to arrays of what they
+            were during each cycle, (cycles, array_size) for array ports."""
+            for name in [*inputs, clock]:
+                assert "IN" in self._args[name]["dir"] and not self._args[name]["array_size"], \
+                    f"{name} is not a scalar input"
+            if cycles is None:
+                cycles = len(next(iter(inputs.values())))
+
+            stimulus = numpy.empty((cycles, len(inputs)), numpy.int64)
+            for i, values in enumerate(inputs.values()):
+                stimulus[:, i] = values
+            widths = [int(self._args[name]["array_size"] or 1) for name in outputs]
+            sampled = numpy.empty((cycles, sum(widths)), numpy.int64)
+
+            port_numbers = lambda names: self._ffi.new("int[]", [self._args[n]["port"] for n in names])
+            getattr(self._lib, self._sv_module+"_run_cycles")(
+                self._tb, cycles, self._args[clock]["port"],
+                len(inputs), port_numbers(inputs), self._ffi.from_buffer("long long[]", stimulus),
+                len(outputs), port_numbers(outputs),
+                self._ffi.from_buffer("long long[]", sampled, require_writable=True),
+            )
+            columns = numpy.cumsum([0, *widths])
+            return {
+                name: sampled[:, o] if not self._args[name]["array_size"] else sampled[:, o:o + width]
+                for name, o, width in zip(outputs, columns, widths)
+            }
 
-            for arg_name, arg in self._args.items():
-                setattr(Pyrilated_, arg_name, create_property(arg_name, arg["array_size"]))
+    # properties only need creating once per class, not per instance
+    for arg_name, arg in Pyrilated_._args.items():
+        setattr(Pyrilated_, arg_name, port_property(Pyrilated_, arg_name, arg))
 
     Pyrilated_.__name__ += Pyrilated_._sv_module
     Pyrilated_.__qualname__ += Pyrilated_._sv_module
     return Pyrilated_
 
-"""These are annoyingly required, see
+"""These used to be required for every signed port, see
 https://veripool.org/guide/latest/faq.html#how-do-i-access-signals-in-c
 
 > Note that even signed ports are declared as unsigned;
 > you must sign extend yourself to the appropriate signal width.
+
+The generated getters and setters do that now for ports declared signed,
+these are still around for anything else.
 """
 def cast_to_unsigned(x, bytes):
     return int.from_bytes(int(x).to_bytes(bytes, signed=True))
@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+
+"""
+Picks one of the qoa implementations next to this file by name, for the
+tests and tools that work with any of them (see -i in qoa_test.py).
+"""
+
+import pathlib
+import sys
+
+MODULES = pathlib.Path(__file__).parent.resolve()
+
+def implementation_names():
+    """Every module in MODULES, except this one."""
+    return [m.stem for m in sorted(MODULES.glob("*.py")) if m.stem != pathlib.Path(__file__).stem]
+
+def add_implementation_argument(parser, **kwargs):
+    """-i/--implementation, picking one of the modules in python/."""
+    kwargs.setdefault("default", "python_qoa")
+    parser.add_argument("-i", "--implementation",
+                        choices=implementation_names(),
+                        **kwargs,
+    )
+
+def import_implementation(name):
+    if str(MODULES) not in sys.path:
+        sys.path.append(str(MODULES))
+    return __import__(name)
@@ -9,39 +9,75 @@ the python implementation.
 """
 
 from pathlib import Path
-import logging
+import math
+import numpy
 import struct
 import sys
 
+import python_qoa
+
 # TODO: split off pyrilator in a separate project
 sys.path.append(str((Path(__file__)/"../../pyrilator").resolve()))
-from pyrilator import pyrilate, cast_to_unsigned, cast_to_signed, MAX_INT32
+from pyrilator import pyrilate
 BUILD_DIR = Path(__file__)/"../../build/"
 
 class Lms:
     VERILOG_PATH = (Path(__file__)/"../../verilog/lms.sv").resolve()
+    MULTIPLIERS = 4 # see lms.sv, variant() for the others
+    WEIGHT_BITS = 16 # lms.sv's weights wrap past that, qoa.h's int ones don't
     LmsDut = pyrilate(VERILOG_PATH, build_dir=BUILD_DIR)
 
     STRUCT = struct.Struct(">4h4h")
 
+    _variants = {}
+
+    @classmethod
+    def variant(cls, multipliers):
+        """Lms on the lms.sv datapath with that many multipliers."""
+        if multipliers == Lms.MULTIPLIERS:
+            return Lms
+        if multipliers not in cls._variants:
+            cls._variants[multipliers] = type(f"Lms{multipliers}", (Lms,), dict(
+                MULTIPLIERS = multipliers,
+                LmsDut = pyrilate(cls.VERILOG_PATH, build_dir=BUILD_DIR,
+                                  parameters=dict(MULTIPLIERS=multipliers)),
+            ))
+        return cls._variants[multipliers]
+
+    @classmethod
+    def variants(cls):
+        return [cls.variant(multipliers) for multipliers in (4, 2, 1)]
+
+    @classmethod
+    def clocks_per_update(cls):
+        """How often there can be an update, see lms.sv."""
+        if cls.MULTIPLIERS == 4:
+            return 1
+        return 4 // cls.MULTIPLIERS + 1
+
     def _clock(self):
         self.dut.clk = 0
         self.dut.eval()
         self.dut.clk = 1
         self.dut.eval()
 
+    def _wait_for_prediction(self):
+        while not self.dut.prediction_valid:
+            self._clock()
+
     def __init__(self):
         self.dut = self.LmsDut()
         self.dut.rst = 1
         self._clock()
         self.dut.rst = 0
+        self._wait_for_prediction()
 
     @property
     def weights(self):
-        return [cast_to_signed(x, 2) for x in self.dut.save_weights]
+        return self.dut.save_weights.tolist()
     @property
     def history(self):
-        return [cast_to_signed(x, 2) for x in self.dut.save_history]
+        return self.dut.save_history.tolist()
 
     @classmethod
     def load(cls, buf:bytes=None, history:list=None, weights:list=None):
@@ -53,33 +89,211 @@ class Lms:
         self = cls()
 
         self.dut.load = 1
-        self.dut.load_history = [cast_to_unsigned(x, 2) for x in history]
-        self.dut.load_weights = [cast_to_unsigned(x, 2) for x in weights]
+        self.dut.load_history = history
+        self.dut.load_weights = weights
         self._clock()
         self.dut.load = 0
-
-        logging.info(self)
+        self._wait_for_prediction()
         return self
 
-    PREDICT_MASK = MAX_INT32 ^ (MAX_INT32 >> 13)
     def predict(self):
-        prediction = self.dut.prediction
-        if prediction & (1<<14):
-            # sign extent
-            prediction |= self.PREDICT_MASK
-        return cast_to_signed(prediction, 4)
+        return self.dut.prediction
 
     def update(self, sample, residual):
         self.dut.update = 1
-        self.dut.sample = cast_to_unsigned(sample, 2)
-        self.dut.delta = cast_to_unsigned(residual >> 4, 2)
+        self.dut.sample = sample
+        self.dut.delta = residual >> 4
         self._clock()
         self.dut.update = 0
+        self._wait_for_prediction()
 
-        # logging.info(f"{self!r} delta={self.dut.delta}")
+    def predict_and_update(self, samples, residuals):
+        """Batched update(), all of them run in one call into C.
+
+        Returns what predict() would have given before each update."""
+        period = self.clocks_per_update()
+        update = numpy.zeros(len(samples) * period)
+        update[::period] = 1
+        sampled = self.dut.run_cycles(dict(
+            update=update,
+            sample=numpy.repeat(samples, period),
+            delta=numpy.repeat(numpy.asarray(residuals) >> 4, period),
+        ), outputs=["prediction", "prediction_valid"])
+        self.dut.update = 0
+        self._wait_for_prediction()
+        assert sampled["prediction_valid"][::period].all(), "updates should wait for the prediction"
+        return sampled["prediction"][::period]
+
+    def stats(self):
+        """pyrilator's profiling counters, to see how much of the time
+        goes to the python bridge instead of simulating."""
+        return self.dut.stats()
 
     def __repr__(self):
-        return f"LMS history={list(self.dut.save_history)} weights={self.dut.save_weights}"
+        return f"LMS history={self.history} weights={self.weights}"
+
+class Decoder(python_qoa.Decoder):
+    """python_qoa.Decoder, but every slice gets decoded by the verilog
+    slice_decoder, one channel of a frame after another."""
+    MODES = ("strict",)
+    FRAME_MODES = ("strict",)
+    WEIGHT_BITS = Lms.WEIGHT_BITS # same lms.sv in every slice_decoder
+    VERILOG_PATH = (Path(__file__)/"../../verilog/slice_decoder.sv").resolve()
+    SliceDecoderDut = pyrilate(VERILOG_PATH, build_dir=BUILD_DIR)
+
+    def __init__(self):
+        self.dut = self.SliceDecoderDut()
+        self.dut.run_cycles(dict(rst=[1]))
+        self.dut.rst = 0
+        self.dut.stats(reset=True)
+        self.decoded_sample_count = 0
+
+    def decode_channel(self, lms_state, slices):
+        """Run one channel's slices of a frame through the dut, starting
+        from lms_state (history, weights). Returns every sample of every
+        slice, one sample per clock after a clock to load the first."""
+        cycles = 1 + len(slices) * python_qoa.QOA_SLICE_LEN
+        lms_load = numpy.zeros(cycles, numpy.int64)
+        lms_load[0] = 1
+        # the next slice loads along with the last sample of the previous
+        load_slice = numpy.zeros(cycles, numpy.int64)
+        load_slice[0:-1:python_qoa.QOA_SLICE_LEN] = 1
+        new_slice_data = numpy.zeros(cycles, numpy.int64)
+        new_slice_data[load_slice == 1] = slices.astype(numpy.uint64).view(numpy.int64)
+
+        self.dut.lms_load_history = lms_state[0]
+        self.dut.lms_load_weights = lms_state[1]
+        sampled = self.dut.run_cycles(dict(
+            lms_load=lms_load,
+            load_slice=load_slice,
+            new_slice_data=new_slice_data,
+        ), outputs=["sample", "sample_valid", "slice_empty"])
+        assert sampled["slice_empty"][load_slice == 1].all(), "slices should only load when the last one is done"
+        assert sampled["sample_valid"][1:].all(), "should be one sample every clock"
+        return sampled["sample"][1:]
+
+    def unpack_frame(self, frame_buf):
+        """Returns the frame's lms state as (channels, 2, 4) history and
+        weights, and its slices as (slices, channels)."""
+        o = python_qoa.FRAME_HEADER_STRUCT.size
+
+        lms_state = numpy.frombuffer(frame_buf, ">i2", count=8 * self.channels, offset=o)
+        lms_state = lms_state.reshape(self.channels, 2, 4)
+        o += Lms.STRUCT.size * self.channels
+
+        slice_count = math.ceil(self.fsamples / python_qoa.QOA_SLICE_LEN)
+        slices = numpy.frombuffer(frame_buf, python_qoa.SLICE_DTYPE, count=slice_count * self.channels, offset=o)
+        slices = slices.reshape(slice_count, self.channels)
+        o += slices.nbytes
+        assert o == self.fsize, "we should have consumed the whole frame"
+        return lms_state, slices
+
+    def trace_frame(self, frame_offset, lms_state, slice_count):
+        """Record the frame's start and end states, if there's a trace.
+        The dut doesn't show the state in between slices."""
+        if self.trace is not None:
+            self.trace.record(frame_offset, self.fsize, self.fsamples, python_qoa.FRAME_START,
+                              lms_state[:, 0], lms_state[:, 1])
+            self.trace.record_lms(frame_offset, self.fsize, self.fsamples, slice_count - 1, self.lms)
+
+    def decode_frame(self, frame_buf, dest, frame_offset=0):
+        """Decode one frame from frame_buf into dest. The Lms of every
+        channel are left in self.lms, as python_qoa.Lms."""
+        frame_buf = memoryview(frame_buf)
+        self.decode_frame_header(frame_buf)
+        lms_state, slices = self.unpack_frame(frame_buf)
+
+        self.lms = []
+        for ch in range(self.channels):
+            # the last slice of the last frame may be padded, crop it
+            dest[:self.fsamples, ch] = self.decode_channel(lms_state[ch], slices[:, ch])[:self.fsamples]
+            self.lms.append(python_qoa.Lms.load(
+                history=self.dut.lms_save_history.tolist(),
+                weights=self.dut.lms_save_weights.tolist(),
+            ))
+        self.trace_frame(frame_offset, lms_state, len(slices))
+        self.decoded_sample_count += self.fsamples * self.channels
+        return self.fsize
+
+    def samples_per_clock(self):
+        """Samples decoded by this instance per clock of the dut."""
+        if self.dut is None:
+            return 0
+        return self.decoded_sample_count / max(self.dut.stats()["cycles"], 1)
+
+class FrameDecoder(Decoder):
+    """Decoder, but with the verilog frame_decoder, which has a lane per
+    channel. So every clock gives out a sample of every channel."""
+    VERILOG_PATH = (Path(__file__)/"../../verilog/frame_decoder.sv").resolve()
+    MAX_CHANNELS = python_qoa.QOA_SLICE_LEN # see frame_decoder.sv
+    _duts = {} # channels => pyrilated frame_decoder with that many lanes
+
+    def __init__(self):
+        # the amount of lanes depends on the file, see decode_frame()
+        self.dut = None
+        self.decoded_sample_count = 0
+
+    @classmethod
+    def frame_decoder_dut(cls, channels):
+        if channels not in cls._duts:
+            cls._duts[channels] = pyrilate(cls.VERILOG_PATH, build_dir=BUILD_DIR,
+                                           parameters=dict(CHANNELS=channels))
+        return cls._duts[channels]
+
+    def decode_frame(self, frame_buf, dest, frame_offset=0):
+        """Decode one frame from frame_buf into dest. The Lms of every
+        channel are left in self.lms, as python_qoa.Lms.
+
+        The interleaved slices go in one per clock: the first of every
+        channel, then the next ones during the 20 clocks it takes the
+        lanes to decode the previous ones."""
+        frame_buf = memoryview(frame_buf)
+        self.decode_frame_header(frame_buf)
+        lms_state, slices = self.unpack_frame(frame_buf)
+        channels = self.channels
+        assert channels <= self.MAX_CHANNELS, f"frame_decoder can't keep up with {channels} channels"
+
+        if self.dut is None:
+            self.dut = self.frame_decoder_dut(channels)()
+            self.dut.run_cycles(dict(rst=[1]))
+            self.dut.rst = 0
+            self.dut.stats(reset=True)
+
+        slice_len = python_qoa.QOA_SLICE_LEN
+        slice_count = len(slices)
+        cycles = channels + slice_count * slice_len + 1
+        # slice n starts loading when the lanes start on slice n - 1
+        load_starts = numpy.concatenate([[0], channels + slice_len * numpy.arange(slice_count - 1)])
+        load_cycles = (load_starts[:, None] + numpy.arange(channels)).ravel()
+
+        lms_load = numpy.zeros(cycles, numpy.int64)
+        lms_load[0] = 1
+        load_slice = numpy.zeros(cycles, numpy.int64)
+        load_slice[load_cycles] = 1
+        new_slice_data = numpy.zeros(cycles, numpy.int64)
+        new_slice_data[load_cycles] = slices.ravel().astype(numpy.uint64).view(numpy.int64)
+
+        self.dut.lms_load_history = lms_state[:, 0].ravel()
+        self.dut.lms_load_weights = lms_state[:, 1].ravel()
+        sampled = self.dut.run_cycles(dict(
+            lms_load=lms_load,
+            load_slice=load_slice,
+            new_slice_data=new_slice_data,
+        ), outputs=["samples", "samples_valid", "slice_ready"])
+        assert sampled["slice_ready"][load_cycles].all(), "slices should only load when there's room"
+        assert sampled["samples_valid"][channels + 1:].all(), "should be samples every clock"
+
+        # the last slice of the last frame may be padded, crop it
+        dest[:self.fsamples] = sampled["samples"][channels + 1:][:self.fsamples]
+        history = self.dut.lms_save_history.reshape(channels, 4)
+        weights = self.dut.lms_save_weights.reshape(channels, 4)
+        self.lms = [
+            python_qoa.Lms.load(history=history[ch].tolist(), weights=weights[ch].tolist())
+            for ch in range(channels)
+        ]
+        self.trace_frame(frame_offset, lms_state, slice_count)
+        self.decoded_sample_count += self.fsamples * channels
+        return self.fsize
 
 if __name__=="__main__":
     ORIGINAL_WEIGHTS = [0,0,-100,200]
@@ -94,3 +308,21 @@ if __name__=="__main__":
     assert l.history[-1] == -30000
     assert l.weights != ORIGINAL_WEIGHTS
     assert l.predict() == -756
+
+    # the area/throughput trade-off of the lms datapaths
+    updates = 1000
+    for lms in Lms.variants():
+        l = lms.load(history=[0,0,0,100], weights=ORIGINAL_WEIGHTS.copy())
+        l.dut.stats(reset=True)
+        l.predict_and_update(numpy.zeros(updates, numpy.int64), numpy.zeros(updates, numpy.int64))
+        print(f"lms MULTIPLIERS={lms.MULTIPLIERS}: {l.stats()['cycles'] / updates:.2f} clocks/sample")
+
+    # with a .qoa file, see how fast the clock has to be for real time
+    for filename in sys.argv[1:]:
+        for decoder in (Decoder, FrameDecoder):
+            d = decoder.from_file(filename)
+            d.decode()
+            samples_per_clock = d.samples_per_clock()
+            print(f"{filename}: {decoder.__name__} {samples_per_clock:.3f} samples/clock, "
+                  f"{d.samplerate * d.channels / samples_per_clock / 1e6:.3f} MHz for real time "
+                  f"{d.samplerate} Hz x {d.channels} channels")
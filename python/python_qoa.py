@@ -7,14 +7,19 @@ The purpose of this is to implement QOA as an experiment in an easy to
 introspect matter, more as a toolkit to compare against when testing
 other implementations (in a verilog testbench).
 
-**Do not expect this to be fast**, in fact it might be too slow to for real
-time 44100 audio with modern hardware. While I might improve performance
-it won't be to the detrement of readability and simplicity.
+The default "strict" mode goes sample by sample and is slow, it might be
+too slow for real time 44100 audio with modern hardware. The "fast" mode
+(FastLms and numpy) and decode_parallel() do keep up, but the strict path
+stays the readable reference to check everything else against.
 """
 
+import asyncio
 import collections
+import concurrent.futures
 import logging
 import math
+import mmap
+from multiprocessing import shared_memory
 import numpy
 import struct
 
@@ -27,6 +32,9 @@ MAX_SLICES_PER_FRAME = 256
 SAMPLES_PER_FRAME = MAX_SLICES_PER_FRAME * QOA_SLICE_LEN
 
 FIRST_FRAME_OFFSET = FILE_HEADER_STRUCT.size
+# samples (of every channel) per decode_frames_lockstep() call, which
+# needs 6 bytes of each at once
+LOCKSTEP_BATCH_SAMPLES = 1 << 22
 
 def dequant_sf(sf_quant): # in spec [1]
     return round(pow(sf_quant + 1, 2.75))
@@ -64,6 +72,98 @@ assert DEQUANT_TAB == eval("""{
 	{1286, -1286, 4288, -4288, 7718, -7718, 12005, -12005},
 	{1536, -1536, 5120, -5120, 9216, -9216, 14336, -14336},
 }""".replace("{", "[").replace("}", "]"))
+DEQUANT_ARRAY = numpy.array(DEQUANT_TAB, dtype=numpy.int32)
+
+# bit positions of each 3 bit quantized residual, first sample is the MSBs
+SLICE_DTYPE = numpy.dtype(">u8")
+QR_SHIFTS = numpy.arange(QOA_SLICE_LEN - 1, -1, -1, dtype=numpy.uint64) * 3
+
+# the encoder side of DEQUANT_TAB, like qoa_quant_tab and qoa_reciprocal_tab
+# from qoa.h. QUANT_ARRAY takes the scaled residual clamped to [-8, 8] + 8
+QUANT_ARRAY = numpy.array([7, 7, 7, 5, 5, 3, 3, 1, 0, 0, 2, 2, 4, 4, 6, 6, 6], dtype=numpy.intp)
+RECIPROCAL_ARRAY = numpy.array([
+    65536, 9363, 3121, 1457, 781, 475, 311, 216, 156, 117, 90, 71, 57, 47, 39, 32
+], dtype=numpy.int32)
+SCALEFACTORS = numpy.arange(16)
+
+def unpack_slices(buf, count, offset=0):
+    """Unpack count consecutive slices from buf in one go.
+
+    Returns the scalefactors (aka sf_quant), shaped (count,) and the
+    quantized residuals, shaped (count, QOA_SLICE_LEN)."""
+    s = numpy.frombuffer(buf, dtype=SLICE_DTYPE, count=count, offset=offset)
+    scalefactors = (s >> 60).astype(numpy.intp)
+    qr = ((s[:, None] >> QR_SHIFTS) & 0b111).astype(numpy.intp)
+    return scalefactors, qr
+
+def dequantize_slices(buf, count, offset=0):
+    """Dequantized residuals of count slices, shaped (count, QOA_SLICE_LEN)."""
+    scalefactors, qr = unpack_slices(buf, count, offset)
+    return DEQUANT_ARRAY[scalefactors[:, None], qr]
+
+# one record of Trace, the LMS state of a channel somewhere in a frame
+TRACE_DTYPE = numpy.dtype([
+    ("offset", numpy.uint64), # of the frame, in bytes from the start of the file
+    ("fsize", numpy.uint16),
+    ("fsamples", numpy.uint16),
+    ("channel", numpy.uint8),
+    ("slice", numpy.int16), # the state after this slice, or FRAME_START
+    ("history", numpy.int32, 4),
+    ("weights", numpy.int32, 4),
+])
+FRAME_START = -1 # the slice of the state from the frame header
+
+class Trace:
+    """Structured record of what a decoder went through, instead of logging.
+
+    Set one as the trace of a decoder and its strict decodes fill the
+    preallocated records with the LMS state of every channel at the start
+    and end of every frame, or after every slice too if slices is set.
+    Records past capacity are only counted in dropped.
+
+    Every implementation records in the same TRACE_DTYPE, see mismatches()
+    to diff them. Nothing is recorded or formatted without a trace."""
+
+    def __init__(self, capacity=1 << 16, slices=False):
+        self.records = numpy.zeros(capacity, TRACE_DTYPE)
+        self.count = 0
+        self.dropped = 0
+        self.slices = slices
+
+    def record(self, offset, fsize, fsamples, slice, history, weights):
+        """Record the state of every channel, history and weights shaped
+        (channels, 4)."""
+        n = len(history)
+        if self.count + n > len(self.records):
+            self.dropped += n
+            return
+        r = self.records[self.count:self.count + n]
+        r["offset"] = offset
+        r["fsize"] = fsize
+        r["fsamples"] = fsamples
+        r["channel"] = numpy.arange(n)
+        r["slice"] = slice
+        r["history"] = history
+        r["weights"] = weights
+        self.count += n
+
+    def record_lms(self, offset, fsize, fsamples, slice, lms):
+        self.record(offset, fsize, fsamples, slice, [l.history for l in lms], [l.weights for l in lms])
+
+    def array(self):
+        return self.records[:self.count]
+
+    def save(self, filename):
+        numpy.save(filename, self.array())
+
+    @staticmethod
+    def mismatches(a, b):
+        """Records of trace array a that differ from the record of b at
+        the same offset, channel and slice. Records only one of them has
+        (like per slice ones) are skipped."""
+        key = lambda r: (int(r["offset"]), int(r["channel"]), int(r["slice"]))
+        b = {key(r): r for r in b}
+        return [r for r in a if key(r) in b and r != b[key(r)]]
 
 class Lms:
     """
@@ -85,8 +185,6 @@ class Lms:
         self = cls()
         self.history = collections.deque(history, maxlen=4)
         self.weights = list(weights)
-
-        logging.info(self)
         return self
 
     def predict(self): # in spec [4]
@@ -98,8 +196,6 @@ class Lms:
         assert residual.to_bytes(4, signed=True)
         delta = residual >> 4
 
-        # logging.info(f"{self!r} {delta=}")
-
         for i in range(4): # in spec [6]
             self.weights[i] = self.weights[i] + (-delta if self.history[i] < 0 else delta)
             assert self.weights[i].to_bytes(4, signed=True)
@@ -109,19 +205,188 @@ class Lms:
     def __repr__(self):
         return f"LMS history={list(self.history)} weights={self.weights}"
 
-class Decoder():
+class FastLms:
+    """Lms without the overflow checks, for mode="fast". Samples get
+    decoded a run at a time, with the state in local variables."""
+    __slots__ = ("history", "weights")
+
+    def __init__(self, history, weights):
+        self.history = history
+        self.weights = weights
+
+    def decode(self, residuals):
+        """Decode already dequantized residuals, a slice or more, returns
+        the list of samples."""
+        h0, h1, h2, h3 = self.history
+        w0, w1, w2, w3 = self.weights
+        samples = []
+        append = samples.append
+        for r in residuals:
+            s = ((w0 * h0 + w1 * h1 + w2 * h2 + w3 * h3) >> 13) + r # in spec [4] and [5]
+            if s > 32767:
+                s = 32767
+            elif s < -32768:
+                s = -32768
+            append(s)
+
+            d = r >> 4 # in spec [6]
+            w0 += -d if h0 < 0 else d
+            w1 += -d if h1 < 0 else d
+            w2 += -d if h2 < 0 else d
+            w3 += -d if h3 < 0 else d
+            h0, h1, h2, h3 = h1, h2, h3, s # in spec [7]
+        self.history = [h0, h1, h2, h3]
+        self.weights = [w0, w1, w2, w3]
+        return samples
+
+    def __repr__(self):
+        return f"FastLms history={self.history} weights={self.weights}"
+
+def frame_size(channels, slices):
+    """Size in bytes of a frame, like QOA_FRAME_SIZE from qoa.h"""
+    return (FRAME_HEADER_STRUCT.size
+            + Lms.STRUCT.size * channels
+            + SLICE_STRUCT.size * slices * channels)
+
+class RandomAccess:
+    """frame_index(), decode_range(), seek() and read() for decoders with
+    buf, decode_header(), frame_offsets() and decode_frames(frame_offsets, dest)."""
+    position = 0 # in samples, where read() starts, see seek()
+
+    def frame_index(self):
+        """Offset of every frame in self.buf, frame n holds the samples
+        starting at n * SAMPLES_PER_FRAME.
+
+        Only the last frame may be shorter, so when the channel count
+        doesn't change every offset follows from the first frame header.
+        If the file size doesn't add up to that, walk the headers."""
+        if getattr(self, "_frame_index", None) is None:
+            self.decode_header()
+            frames = math.ceil(self.total_sample_count / SAMPLES_PER_FRAME)
+            full_size = frame_size(self.channels, MAX_SLICES_PER_FRAME)
+            last_samples = self.total_sample_count - (frames - 1) * SAMPLES_PER_FRAME
+            last_size = frame_size(self.channels, math.ceil(last_samples / QOA_SLICE_LEN))
+
+            if frames and FIRST_FRAME_OFFSET + (frames - 1) * full_size + last_size == len(self.buf):
+                self._frame_index = [FIRST_FRAME_OFFSET + f * full_size for f in range(frames)]
+            else:
+                self._frame_index = self.frame_offsets()
+        return self._frame_index
+
+    def decode_range(self, start_sample, stop_sample, **kwargs):
+        """Decode only the frames covering [start_sample, stop_sample),
+        return those samples as a numpy array. kwargs go to
+        decode_frames(), like the mode."""
+        index = self.frame_index()
+        stop_sample = min(stop_sample, self.total_sample_count)
+        assert 0 <= start_sample <= stop_sample, f"bad range [{start_sample}:{stop_sample}]"
+
+        first_frame = start_sample // SAMPLES_PER_FRAME
+        stop_frame = math.ceil(stop_sample / SAMPLES_PER_FRAME)
+        samples = numpy.empty(((stop_frame - first_frame) * SAMPLES_PER_FRAME, self.channels), numpy.int16)
+        self.decode_frames(index[first_frame:stop_frame], samples, **kwargs)
+
+        o = first_frame * SAMPLES_PER_FRAME
+        return samples[start_sample - o:stop_sample - o]
+
+    def seek(self, sample_index):
+        """Move where the next read() starts, returns the new position."""
+        self.decode_header()
+        assert 0 <= sample_index <= self.total_sample_count
+        self.position = sample_index
+        return self.position
+
+    def read(self, sample_count, **kwargs):
+        """Decode up to sample_count samples from the seek() position."""
+        samples = self.decode_range(self.position, self.position + sample_count, **kwargs)
+        self.position += len(samples)
+        return samples
+
+class ParallelDecoding:
+    """decode_parallel() for decoders with from_file(), from_bytes(),
+    decode_header(), frame_index() and decode_frames(frame_offsets, dest)."""
+
+    def decode_parallel(self, dest, workers, **kwargs):
+        """Split the frames in ranges and decode them in a process pool,
+        with decode_frames(..., **kwargs).
+
+        Workers write straight into a shared memory array that gets
+        copied into dest at the end."""
+        frame_offsets = self.frame_index()
+        # a few ranges per worker so an unlucky slow one doesn't hold everyone up
+        chunk = max(1, math.ceil(len(frame_offsets) / (workers * 4)))
+
+        shm = shared_memory.SharedMemory(create=True, size=max(dest.nbytes, 1))
+        shared = numpy.ndarray(dest.shape, numpy.int16, buffer=shm.buf)
+        try:
+            with concurrent.futures.ProcessPoolExecutor(
+                workers,
+                initializer=_init_worker,
+                # workers map the file themselves instead of getting a copy
+                initargs=(type(self), getattr(self, "filename", None) or bytes(self.buf),
+                          shm.name, dest.shape),
+            ) as pool:
+                jobs = [
+                    pool.submit(_decode_frames_in_worker,
+                                first, frame_offsets[first:first + chunk], kwargs)
+                    for first in range(0, len(frame_offsets), chunk)
+                ]
+                for job in jobs:
+                    job.result()
+            dest[:] = shared
+        finally:
+            del shared
+            shm.close()
+            shm.unlink()
+
+_worker = None # (decoder, shared_memory, samples) of this pool worker process
+
+def _init_worker(decoder_cls, source, shm_name, shape):
+    global _worker
+    if isinstance(source, bytes):
+        d = decoder_cls.from_bytes(source)
+    else:
+        d = decoder_cls.from_file(source)
+    d.decode_header()
+    shm = shared_memory.SharedMemory(shm_name)
+    _worker = d, shm, numpy.ndarray(shape, numpy.int16, buffer=shm.buf)
+
+def _decode_frames_in_worker(first_frame, frame_offsets, kwargs):
+    # every frame but the last one is full, so this is where our range starts
+    d, _, samples = _worker
+    return d.decode_frames(frame_offsets, samples[first_frame * SAMPLES_PER_FRAME:], **kwargs)
+
+class Decoder(RandomAccess, ParallelDecoding):
+    MODES = ("strict", "lockstep", "fast")
+    FRAME_MODES = ("strict", "fast") # the MODES iter_frames() can go a frame at a time with
+    trace = None # a Trace to record strict decodes into
+
     @classmethod
     def from_file(cls, filename):
+        """Memory map filename, frames only get paged in when decoded."""
         self = cls()
+        self.filename = filename
         with open(filename, "br") as f:
-            self.buf = f.read()
+            self.buf = memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
         logging.info(f"Decoding {filename!r}, {len(self.buf)} bytes long...")
         return self
 
+    @classmethod
+    def from_bytes(cls, data):
+        self = cls()
+        self.buf = memoryview(data)
+        return self
+
     def decode_header(self):
         magic, self.total_sample_count = FILE_HEADER_STRUCT.unpack_from(self.buf)
         assert magic == MAGIC
-        self.decode_frame_header(self.buf[FIRST_FRAME_OFFSET:])
+        self.decode_frame_header(memoryview(self.buf)[FIRST_FRAME_OFFSET:])
+
+    def check_mode(self, mode, modes=None):
+        """Subclasses only decode with their own MODES, anything else
+        would decode with python in their name."""
+        modes = self.MODES if modes is None else modes
+        assert mode in modes, f"{mode=} should be one of {modes}"
 
     def decode_frame_header(self, frame_buf, dynamic_ok=False):
         (
@@ -131,7 +396,6 @@ class Decoder():
             self.fsize,
         ) = FRAME_HEADER_STRUCT.unpack_from(frame_buf)
         frame_samplerate = int.from_bytes(frame_samplerate_s, 'big')
-        logging.info(f"fsize={self.fsize} => fsamples={self.fsamples}")
 
         if hasattr(self, "samplerate"):
             assert (self.samplerate == frame_samplerate) or dynamic_ok
@@ -141,21 +405,19 @@ class Decoder():
         self.channels = frame_channels
 
     @staticmethod
-    def decode_slice(lms, slice_buf):
-        """Generator to decode one slice, yield each samples"""
-        s, = SLICE_STRUCT.unpack(slice_buf)
-        scalefactor = s >> 60 # aka sf_quant
-        qr = [(s >> (i*3)) & 0b111 for i in reversed(range(0, QOA_SLICE_LEN))]
-        # logging.info(f"{scalefactor} {qr!r}")
-        for quantized in qr:
+    def decode_slice(lms, residuals):
+        """Generator to decode one slice from its already dequantized
+        residuals (see dequantize_slices), yield each samples"""
+        for dequantized in residuals:
             predicted = lms.predict()
-            dequantized = DEQUANT_TAB[scalefactor][quantized]
             reconstructed = numpy.clip(predicted + dequantized, -32768, 32767)
             yield reconstructed # in spec [5]
             lms.update(sample=reconstructed, residual=dequantized)
 
-    def decode_frame(self, frame_buf, dest):
-        """Decode one frame from frame_buf into dest."""
+    def decode_frame(self, frame_buf, dest, frame_offset=0):
+        """Decode one frame from frame_buf into dest. The Lms of every
+        channel are left in self.lms. frame_offset is only for the trace."""
+        frame_buf = memoryview(frame_buf)
         self.decode_frame_header(frame_buf)
         o = FRAME_HEADER_STRUCT.size
 
@@ -164,36 +426,205 @@ class Decoder():
             lms.append(Lms.load(frame_buf[o:]))
             o += Lms.STRUCT.size
 
+        trace = self.trace
+        if trace is not None:
+            trace.record_lms(frame_offset, self.fsize, self.fsamples, FRAME_START, lms)
+        trace_slices = trace is not None and trace.slices
+
+        slices = math.ceil(self.fsamples / QOA_SLICE_LEN)
+        residuals = iter(dequantize_slices(frame_buf, slices * self.channels, offset=o).tolist())
+
         for sample_index in range(0, self.fsamples, QOA_SLICE_LEN):
             for ch in range(self.channels):
-                # logging.info(f"{ch=} {sample_index=}")
-                slice_buf = frame_buf[o:o+SLICE_STRUCT.size]
-                slice_samples = tuple(self.decode_slice(lms[ch], slice_buf))
+                slice_samples = tuple(self.decode_slice(lms[ch], next(residuals)))
                 try:
                     dest[sample_index : sample_index + QOA_SLICE_LEN,ch] = slice_samples
                 except ValueError:
                     # "The last slice (for each channel) in the last
                     # frame may contain less than 20 samples"
                     # so let's crop slice_samples so it fits
-                    slice_samples = slice_samples[:self.total_sample_count % QOA_SLICE_LEN]
+                    slice_samples = slice_samples[:self.fsamples - sample_index]
                     dest[sample_index : sample_index + QOA_SLICE_LEN,ch] = slice_samples
                 o += SLICE_STRUCT.size
+            if trace_slices:
+                trace.record_lms(frame_offset, self.fsize, self.fsamples, sample_index // QOA_SLICE_LEN, lms)
 
         assert o == self.fsize, "we should have consumed the whole frame"
+        if trace is not None and not trace_slices:
+            trace.record_lms(frame_offset, self.fsize, self.fsamples, slices - 1, lms)
+        self.lms = lms
         return self.fsize
 
-    def decode(self, _check_against=None):
-        """Decode then return numpy array with whole file."""
+    def decode_frame_fast(self, frame_buf, dest, frame_offset=0):
+        """decode_frame(), but with FastLms a whole channel at a time.
+        Per slice traces need decode_frame()."""
+        if self.trace is not None and self.trace.slices:
+            return self.decode_frame(frame_buf, dest, frame_offset)
+
+        frame_buf = memoryview(frame_buf)
+        self.decode_frame_header(frame_buf)
+        o = FRAME_HEADER_STRUCT.size
+
+        lms_state = numpy.frombuffer(frame_buf, ">i2", count=8 * self.channels, offset=o)
+        lms = [FastLms(history, weights) for history, weights in lms_state.reshape(self.channels, 2, 4).tolist()]
+        o += Lms.STRUCT.size * self.channels
+        if self.trace is not None:
+            self.trace.record_lms(frame_offset, self.fsize, self.fsamples, FRAME_START, lms)
+
+        slices = math.ceil(self.fsamples / QOA_SLICE_LEN)
+        residuals = dequantize_slices(frame_buf, slices * self.channels, offset=o)
+        o += residuals.size // QOA_SLICE_LEN * SLICE_STRUCT.size
+        assert o == self.fsize, "we should have consumed the whole frame"
+
+        # (slices, channels, QOA_SLICE_LEN) => every residual of a channel in a row
+        residuals = residuals.reshape(slices, self.channels, QOA_SLICE_LEN).transpose(1, 0, 2)
+        for ch, channel_residuals in enumerate(residuals.reshape(self.channels, -1).tolist()):
+            # the last slice of the last frame may be padded, crop it
+            dest[:self.fsamples, ch] = lms[ch].decode(channel_residuals)[:self.fsamples]
+
+        if self.trace is not None:
+            self.trace.record_lms(frame_offset, self.fsize, self.fsamples, slices - 1, lms)
+        self.lms = lms
+        return self.fsize
+
+    def iter_frames(self, mode="strict"):
+        """Generator to decode one frame at a time, yields (samples, lms)
+        for each frame, lms being the state of every channel at the end
+        of that frame. Only one frame of samples is in memory at once."""
+        self.check_mode(mode, self.FRAME_MODES)
+        decode_frame = self.decode_frame_fast if mode == "fast" else self.decode_frame
+        self.decode_header()
+        buf = memoryview(self.buf)
+        sample_index = 0
+        frame_offset = FIRST_FRAME_OFFSET
+
+        while sample_index < self.total_sample_count:
+            self.decode_frame_header(buf[frame_offset:])
+            samples = numpy.empty((self.fsamples, self.channels), numpy.int16)
+            frame_offset += decode_frame(buf[frame_offset:], samples, frame_offset)
+            sample_index += self.fsamples
+            yield samples, self.lms
+
+    def frame_offsets(self):
+        """Walk the frame headers, return the offset of every frame."""
+        buf = memoryview(self.buf)
+        offsets = []
+        sample_index = 0
+        frame_offset = FIRST_FRAME_OFFSET
+
+        while sample_index < self.total_sample_count:
+            self.decode_frame_header(buf[frame_offset:])
+            if not self.fsize:
+                break
+            offsets.append(frame_offset)
+            frame_offset += self.fsize
+            sample_index += self.fsamples
+        return offsets
+
+    def decode_frames_lockstep(self, frame_offsets, dest):
+        """Decode all the frames at frame_offsets together into dest.
+
+        Every frame header carries its own LMS state, so frames don't
+        depend on each other. Load every LMS into (frames, channels, 4)
+        arrays, then step all of them through the sample positions at
+        once. Returns the amount of samples written to dest."""
+        buf = memoryview(self.buf)
+        frames = len(frame_offsets)
+        history = numpy.empty((frames, self.channels, 4), numpy.int64)
+        weights = numpy.empty_like(history)
+        residuals = numpy.zeros((MAX_SLICES_PER_FRAME, QOA_SLICE_LEN, frames, self.channels), numpy.int32)
+
+        sample_count = 0
+        for f, frame_offset in enumerate(frame_offsets):
+            assert sample_count == f * SAMPLES_PER_FRAME, "only the last frame may be short"
+            self.decode_frame_header(buf[frame_offset:])
+            o = frame_offset + FRAME_HEADER_STRUCT.size
+
+            lms_state = numpy.frombuffer(buf, ">i2", count=8 * self.channels, offset=o)
+            lms_state = lms_state.reshape(self.channels, 2, 4)
+            history[f] = lms_state[:, 0]
+            weights[f] = lms_state[:, 1]
+            o += Lms.STRUCT.size * self.channels
+
+            slices = math.ceil(self.fsamples / QOA_SLICE_LEN)
+            frame_residuals = dequantize_slices(buf, slices * self.channels, offset=o)
+            # (slices, channels, QOA_SLICE_LEN) => (slices, QOA_SLICE_LEN, channels)
+            residuals[:slices, :, f] = frame_residuals.reshape(
+                slices, self.channels, QOA_SLICE_LEN).transpose(0, 2, 1)
+            o += frame_residuals.size // QOA_SLICE_LEN * SLICE_STRUCT.size
+
+            assert o == frame_offset + self.fsize, "we should have consumed the whole frame"
+            sample_count += self.fsamples
+
+        residuals = residuals.reshape(SAMPLES_PER_FRAME, frames, self.channels)
+        reconstructed = numpy.empty((SAMPLES_PER_FRAME, frames, self.channels), numpy.int16)
+        for i in range(min(sample_count, SAMPLES_PER_FRAME)):
+            predicted = (history * weights).sum(axis=-1) >> 13 # in spec [4]
+            sample = numpy.clip(predicted + residuals[i], -32768, 32767)
+            reconstructed[i] = sample # in spec [5]
+
+            delta = (residuals[i] >> 4)[..., None]
+            weights += numpy.where(history < 0, -delta, delta) # in spec [6]
+            history[..., :-1] = history[..., 1:] # in spec [7]
+            history[..., -1] = sample
+
+        # frames are consecutive, so (position, frame, ch) => (frame, position, ch)
+        dest[:sample_count] = reconstructed.transpose(1, 0, 2).reshape(
+            frames * SAMPLES_PER_FRAME, self.channels)[:sample_count]
+        return sample_count
+
+    def decode_frames(self, frame_offsets, dest, mode="strict"):
+        """Decode the consecutive frames at frame_offsets into dest.
+        Returns the amount of samples written to dest."""
+        self.check_mode(mode)
+        if mode == "lockstep":
+            # in batches, so memory doesn't grow with the file
+            batch = max(1, LOCKSTEP_BATCH_SAMPLES // (SAMPLES_PER_FRAME * self.channels))
+            sample_index = 0
+            for b in range(0, len(frame_offsets), batch):
+                sample_index += self.decode_frames_lockstep(frame_offsets[b:b + batch], dest[sample_index:])
+            return sample_index
+        decode_frame = self.decode_frame_fast if mode == "fast" else self.decode_frame
+
+        buf = memoryview(self.buf)
+        sample_index = 0
+        for frame_offset in frame_offsets:
+            decode_frame(buf[frame_offset:], dest[sample_index:], frame_offset)
+            sample_index += self.fsamples
+        return sample_index
+
+    def decode_parallel(self, dest, workers, mode="strict"):
+        self.check_mode(mode)
+        super().decode_parallel(dest, workers, mode=mode)
+
+    def decode(self, _check_against=None, mode="strict", workers=None):
+        """Decode then return numpy array with whole file.
+
+        mode="strict" decodes one frame at a time with all the overflow
+        checks in Lms, mode="fast" does too but without them, with
+        FastLms. mode="lockstep" decodes batches of frames at once
+        with decode_frames_lockstep(). With workers the frames are split
+        across that many processes, see decode_parallel()."""
+        self.check_mode(mode)
         self.decode_header()
         samples = numpy.empty((self.total_sample_count, self.channels), numpy.int16)
 
+        if workers or mode == "lockstep":
+            if workers:
+                self.decode_parallel(samples, workers, mode)
+            else:
+                self.decode_frames(self.frame_index(), samples, mode)
+            if _check_against is not None:
+                assert (_check_against[:len(samples)] == samples).all()
+            return samples
+
+        decode_frame = self.decode_frame_fast if mode == "fast" else self.decode_frame
+        buf = memoryview(self.buf)
         sample_index = 0
         frame_offset = FIRST_FRAME_OFFSET
 
         while sample_index < self.total_sample_count:
-            logging.info(f"starting a frame @{frame_offset} => samples @[{sample_index}: +{self.fsamples}] / {self.total_sample_count} total")
-            frame_size = self.decode_frame(self.buf[frame_offset:], samples[sample_index:])
-            logging.info(f"finished a {frame_size=} @{frame_offset} => samples @[{sample_index}: +{self.fsamples}] / {self.total_sample_count} total")
+            frame_size = decode_frame(buf[frame_offset:], samples[sample_index:], frame_offset)
 
             if not frame_size:
                 break
@@ -206,8 +637,213 @@ class Decoder():
             sample_index += self.fsamples
         return samples
 
-logging.basicConfig(
-    # style="{",
-    format = "%(funcName)s() %(message)s",
-    level = logging.DEBUG
-)
+class StreamDecoder(Decoder):
+    """Push style decoder, feed() it bytes as they come in and it gives
+    out the samples of every frame as soon as that frame is complete.
+
+    Only one partial frame is ever buffered. The channels and samplerate
+    may change from frame to frame, and a total_sample_count of 0 in the
+    file header means it's a stream with no known end. mode is one of
+    FRAME_MODES, "fast" keeps up with live audio, "strict" doesn't."""
+
+    def __init__(self, mode="fast"):
+        self.check_mode(mode, self.FRAME_MODES)
+        self.mode = mode
+        self.pending = bytearray()
+        self.total_sample_count = None # until the file header is in
+        self.sample_count = 0 # decoded so far
+        self.offset = 0 # in the stream, of the start of pending
+
+    def done(self):
+        return bool(self.total_sample_count) and self.sample_count >= self.total_sample_count
+
+    def feed(self, chunk):
+        """Buffer chunk, return a list with the samples of every frame
+        it completed, each shaped (fsamples, channels)."""
+        self.pending += chunk
+        decode_frame = self.decode_frame_fast if self.mode == "fast" else self.decode_frame
+        frames = []
+        start = 0 # of the next frame in pending, what's before goes once done
+
+        with memoryview(self.pending) as buf:
+            if self.total_sample_count is None:
+                if len(buf) < FIRST_FRAME_OFFSET:
+                    return frames
+                magic, self.total_sample_count = FILE_HEADER_STRUCT.unpack_from(buf)
+                assert magic == MAGIC
+                start = FIRST_FRAME_OFFSET
+
+            while not self.done() and len(buf) - start >= FRAME_HEADER_STRUCT.size:
+                self.decode_frame_header(buf[start:], dynamic_ok=True)
+                assert FRAME_HEADER_STRUCT.size < self.fsize <= frame_size(self.channels, MAX_SLICES_PER_FRAME), \
+                    f"bad frame size {self.fsize}"
+                if len(buf) - start < self.fsize:
+                    break
+
+                samples = numpy.empty((self.fsamples, self.channels), numpy.int16)
+                decode_frame(buf[start:start + self.fsize], samples, self.offset + start)
+                start += self.fsize
+                self.sample_count += self.fsamples
+                frames.append(samples)
+
+        del self.pending[:start]
+        self.offset += start
+        return frames
+
+    def close(self):
+        """Done feeding, there shouldn't be anything left over."""
+        assert not self.pending or self.done(), f"{len(self.pending)} bytes of an unfinished frame left"
+        assert not self.total_sample_count or self.done(), \
+            f"got {self.sample_count} samples, the header says {self.total_sample_count}"
+
+async def decode_stream(reader:asyncio.StreamReader, chunk_size=4096, decoder=None):
+    """Async generator of the samples of every frame read from reader,
+    as soon as each frame is in. Decoding runs in the loop's default
+    executor, so it doesn't block the loop."""
+    decoder = decoder or StreamDecoder()
+    loop = asyncio.get_running_loop()
+    while not decoder.done():
+        chunk = await reader.read(chunk_size)
+        if not chunk:
+            break
+        for samples in await loop.run_in_executor(None, decoder.feed, chunk):
+            yield samples
+    decoder.close()
+
+class Encoder():
+    """Encodes the same bytes as qoa_encode() from qoa.h.
+
+    Every slice is tried with all 16 scalefactors at once as numpy arrays
+    shaped (channels, 16), the one with the lowest rank wins. Samples
+    can be given a frame at a time, see iter_encode()."""
+
+    def __init__(self, channels, samplerate, total_sample_count):
+        assert 0 < channels <= 255 and 0 < samplerate <= 0xffffff and total_sample_count > 0
+        self.channels = channels
+        self.samplerate = samplerate
+        self.total_sample_count = total_sample_count
+        self.sample_count = 0 # encoded so far
+
+        # like qoa_encode(), int32 so it overflows like the C does
+        self.history = numpy.zeros((channels, 4), numpy.int32)
+        self.weights = numpy.tile(numpy.array([0, 0, -(1 << 13), 1 << 14], numpy.int32), (channels, 1))
+
+    def encode_header(self):
+        return FILE_HEADER_STRUCT.pack(MAGIC, self.total_sample_count)
+
+    def encode_slices(self, samples):
+        """Encode the slice of every channel at one sample index, samples
+        shaped (slice_len, channels). Returns the ranks, quantized slices
+        and resulting LMS of every scalefactor, ranks shaped
+        (slice_len, channels, 16) to be picked from with pick_slices()."""
+        history = numpy.repeat(self.history[:, None], 16, axis=1)
+        weights = numpy.repeat(self.weights[:, None], 16, axis=1)
+        slices = numpy.broadcast_to(SCALEFACTORS.astype(numpy.uint64), (self.channels, 16))
+        rank = numpy.zeros((self.channels, 16), numpy.uint64)
+        ranks = numpy.empty((len(samples), self.channels, 16), numpy.uint64)
+
+        for i, sample in enumerate(samples.astype(numpy.int32)[:, :, None]):
+            predicted = (history * weights).sum(axis=-1, dtype=numpy.int32) >> 13 # in spec [4]
+            residual = sample - predicted
+
+            # qoa_div(), a rounding division by the scalefactor
+            scaled = (residual * RECIPROCAL_ARRAY + (1 << 15)) >> 16
+            scaled += numpy.sign(residual) - numpy.sign(scaled)
+            quantized = QUANT_ARRAY[numpy.clip(scaled, -8, 8) + 8]
+            dequantized = DEQUANT_ARRAY[SCALEFACTORS, quantized]
+            reconstructed = numpy.clip(predicted + dequantized, -32768, 32767)
+
+            # keep the weights from growing too large
+            penalty = ((weights * weights).sum(axis=-1, dtype=numpy.int32) >> 18) - 0x8ff
+            penalty = numpy.maximum(penalty, 0)
+            error = (sample - reconstructed).astype(numpy.int64)
+            rank += (error * error).astype(numpy.uint64)
+            rank += (penalty * penalty).astype(numpy.int64).astype(numpy.uint64)
+            ranks[i] = rank
+
+            delta = (dequantized >> 4)[..., None]
+            weights += numpy.where(history < 0, -delta, delta) # in spec [6]
+            history[..., :-1] = history[..., 1:] # in spec [7]
+            history[..., -1] = reconstructed
+            slices = (slices << numpy.uint64(3)) | quantized.astype(numpy.uint64)
+
+        return ranks, slices, history, weights
+
+    @staticmethod
+    def pick_slices(ranks, prev_scalefactor):
+        """The winning scalefactor of every channel. Like qoa.h they're
+        tried starting from prev_scalefactor, the first lowest rank wins."""
+        channels = ranks.shape[1]
+        order = (SCALEFACTORS + prev_scalefactor[:, None]) % 16
+        if (ranks[1:] >= ranks[:-1]).all():
+            final = numpy.take_along_axis(ranks[-1], order, axis=1)
+            return order[numpy.arange(channels), final.argmin(axis=1)]
+
+        # a rank overflowed, so it's not the final rank that counts but
+        # when qoa.h gives up on a scalefactor, go through them like it does
+        best = numpy.zeros(channels, numpy.intp)
+        for c in range(channels):
+            best_rank = (1 << 64) - 1
+            for sf in order[c]:
+                if (ranks[:, c, sf] > best_rank).any():
+                    continue
+                if ranks[-1, c, sf] < best_rank:
+                    best_rank, best[c] = int(ranks[-1, c, sf]), sf
+        return best
+
+    def encode_frame(self, samples):
+        """Encode up to SAMPLES_PER_FRAME samples, shaped (fsamples,
+        channels), into a frame. Only the last one may be short."""
+        fsamples = len(samples)
+        assert samples.shape[1:] == (self.channels,)
+        assert 0 < fsamples <= SAMPLES_PER_FRAME
+        assert fsamples == SAMPLES_PER_FRAME or self.sample_count + fsamples == self.total_sample_count, \
+            "only the last frame may be short"
+
+        slice_count = math.ceil(fsamples / QOA_SLICE_LEN)
+        fsize = frame_size(self.channels, slice_count)
+        header = FRAME_HEADER_STRUCT.pack(self.channels, self.samplerate.to_bytes(3, "big"), fsamples, fsize)
+        # weights don't always fit, they get cut to 16 bits like in qoa.h
+        lms_state = numpy.stack([self.history, self.weights], axis=1).astype(">i2").tobytes()
+
+        slices = numpy.empty((slice_count, self.channels), SLICE_DTYPE)
+        prev_scalefactor = numpy.zeros(self.channels, numpy.intp)
+        channels = numpy.arange(self.channels)
+        for i, sample_index in enumerate(range(0, fsamples, QOA_SLICE_LEN)):
+            slice_samples = samples[sample_index:sample_index + QOA_SLICE_LEN]
+            ranks, candidates, history, weights = self.encode_slices(slice_samples)
+            best = self.pick_slices(ranks, prev_scalefactor)
+
+            prev_scalefactor = best
+            self.history = history[channels, best]
+            self.weights = weights[channels, best]
+            # a short last slice still starts at the MSBs
+            slices[i] = candidates[channels, best] << numpy.uint64((QOA_SLICE_LEN - len(slice_samples)) * 3)
+
+        self.sample_count += fsamples
+        frame = header + lms_state + slices.tobytes()
+        assert len(frame) == fsize
+        return frame
+
+    def iter_encode(self, chunks):
+        """Generator to encode chunks of samples shaped (n, channels),
+        of any length, as they come. Yields the file header then every
+        frame as soon as there's enough samples for it."""
+        yield self.encode_header()
+        pending = numpy.empty((0, self.channels), numpy.int16)
+        for chunk in chunks:
+            pending = numpy.concatenate([pending, numpy.asarray(chunk, numpy.int16).reshape(-1, self.channels)])
+            while len(pending) >= SAMPLES_PER_FRAME:
+                yield self.encode_frame(pending[:SAMPLES_PER_FRAME])
+                pending = pending[SAMPLES_PER_FRAME:]
+        if len(pending):
+            yield self.encode_frame(pending)
+        assert self.sample_count == self.total_sample_count, \
+            f"got {self.sample_count} samples, the header says {self.total_sample_count}"
+
+    @classmethod
+    def encode(cls, samples, samplerate):
+        """Encode a whole numpy array shaped (samples, channels)."""
+        self = cls(samples.shape[1], samplerate, len(samples))
+        logging.info(f"Encoding {len(samples)} samples of {self.channels} channels...")
+        return b"".join(self.iter_encode([samples]))
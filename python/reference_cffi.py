@@ -5,66 +5,200 @@ than the pure python, but more accurate (since it includes the reference)
 and way faster."""
 
 import cffi
+import hashlib
+import math
+import mmap
+import os
 import pathlib
 import numpy
+import shutil
 import subprocess
+import sysconfig
+import tempfile
 
-ffi = cffi.FFI()
+import python_qoa
 
 QOA_FILENAME = (pathlib.Path(__file__)/"../../qoa-reference/qoa.h").resolve()
+BUILD_DIR = (pathlib.Path(__file__)/"../../build/").resolve()
 
-# preprocess since cffi cannot do most # directives
-pre = subprocess.check_output([
-    "gcc", "-E", # preprocess only
-    "-P", # inhibit linemarkers
-    QOA_FILENAME,
-], encoding="utf8")
-ffi.cdef(pre)
-ffi.cdef("void free(void *ptr);")
-
-ffi.set_source(
-    "cffi_qoa_impl",
-    """
+C_SOURCE = """
     #define QOA_IMPLEMENTATION
     #include "qoa.h"
-    """,
-    include_dirs = (QOA_FILENAME.parent,))
-lib = ffi.dlopen(ffi.compile(tmpdir="../build/"))
+    """
+COMPILE_ARGS = ["-O3"]
+
+def build():
+    """Compile the wrapper around qoa.h unless BUILD_DIR already has it.
+
+    Builds are keyed by everything that changes the output (qoa.h, the
+    compiler flags, the cffi version and the python ABI), so importing
+    an unchanged reference only needs a dlopen. Several processes may
+    build at once, they each work in a private tmpdir and atomically
+    rename the results in place.
+
+    Returns the path to the shared object and the cdefs to load it with."""
+    key = hashlib.sha256()
+    for part in (QOA_FILENAME.read_bytes(), C_SOURCE, COMPILE_ARGS,
+                 cffi.__version__, sysconfig.get_config_var("EXT_SUFFIX")):
+        key.update(repr(part).encode())
+    module_name = f"cffi_qoa_impl_{key.hexdigest()[:16]}"
+    so_file = BUILD_DIR/(module_name + sysconfig.get_config_var("EXT_SUFFIX"))
+    cdef_file = BUILD_DIR/(module_name + ".cdef")
+
+    if so_file.exists() and cdef_file.exists():
+        return so_file, cdef_file.read_text()
+
+    tmpdir = tempfile.mkdtemp(prefix=module_name, dir=BUILD_DIR)
+    try:
+        # preprocess since cffi cannot do most # directives
+        cdef = subprocess.check_output([
+            "gcc", "-E", # preprocess only
+            "-P", # inhibit linemarkers
+            QOA_FILENAME,
+        ], encoding="utf8")
+        cdef += "void free(void *ptr);\n"
+
+        builder = cffi.FFI()
+        builder.cdef(cdef)
+        builder.set_source(
+            module_name,
+            C_SOURCE,
+            include_dirs = (QOA_FILENAME.parent,),
+            extra_compile_args = COMPILE_ARGS)
+        built = builder.compile(tmpdir=tmpdir)
+
+        # cdef first, so whoever sees so_file can also read cdef_file
+        (pathlib.Path(tmpdir)/"cdef").write_text(cdef)
+        os.replace(pathlib.Path(tmpdir)/"cdef", cdef_file)
+        os.replace(built, so_file)
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return so_file, cdef
+
+ffi = cffi.FFI()
+_so_file, _cdef = build()
+ffi.cdef(_cdef)
+lib = ffi.dlopen(str(_so_file))
+
+# a #define in qoa.h, so cffi can't see it. The frame layout ones are
+# the same as python_qoa's, those get used from there.
+QOA_MAX_CHANNELS = 8
 
 def qoa_to_dict(desc):
     return{k:getattr(desc, k) for k in dir(desc)}
 
-class Decoder():
+class Decoder(python_qoa.RandomAccess, python_qoa.ParallelDecoding):
+    trace = None # a python_qoa.Trace to record decodes into, per frame
+
     def __init__(self, encoded_bytes):
-        self.b = encoded_bytes
+        self.buf = encoded_bytes
+        # C view of the encoded bytes, pointer arithmetic on it is free
+        self.src = ffi.from_buffer("unsigned char[]", encoded_bytes)
         self.desc = ffi.new("qoa_desc *")
+        self.frame_len = ffi.new("unsigned int *") # samples decoded count for a single channel
         assert self.decode_header() == 8
 
     @classmethod
     def from_file(cls, filename):
-        with filename.open("br") as f:
-            file_contents = f.read()
-        return cls(file_contents)
+        """Memory map filename, frames only get paged in when decoded."""
+        with open(filename, "br") as f:
+            self = cls(memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)))
+        self.filename = filename
+        return self
+
+    @classmethod
+    def from_bytes(cls, data):
+        return cls(data)
 
     def decode_header(self):
-        bytes_consumed = lib.qoa_decode_header(self.b, len(self.b), self.desc)
+        bytes_consumed = lib.qoa_decode_header(self.src, len(self.buf), self.desc)
         self.total_sample_count = self.desc.samples
         self.channels = self.desc.channels
         self.samplerate = self.desc.samplerate
         return bytes_consumed
 
     def decode_frame(self, offset, dest_samples):
-        b_slice = self.b[offset:]
-        frame_len = ffi.new("unsigned int *") # samples decoded count for a single channel
-        bytes_consumed = lib.qoa_decode_frame(b_slice, len(b_slice), self.desc, dest_samples, frame_len)
-        return (bytes_consumed, frame_len[0])
+        bytes_consumed = lib.qoa_decode_frame(
+            self.src + offset, len(self.buf) - offset, self.desc, dest_samples, self.frame_len)
+        if self.trace is not None and bytes_consumed:
+            self.trace_frame(offset, bytes_consumed, self.frame_len[0])
+        return (bytes_consumed, self.frame_len[0])
+
+    def trace_frame(self, offset, fsize, fsamples):
+        """Record the state from the frame header and the one qoa.h ended
+        the frame with, qoa.h doesn't show the ones in between."""
+        channels = self.desc.channels
+        lms_state = numpy.frombuffer(self.buf, ">i2", count=8 * channels, offset=offset + 8).reshape(channels, 2, 4)
+        self.trace.record(offset, fsize, fsamples, python_qoa.FRAME_START, lms_state[:, 0], lms_state[:, 1])
+        self.trace.record(offset, fsize, fsamples, math.ceil(fsamples / python_qoa.QOA_SLICE_LEN) - 1,
+                          [list(self.desc.lms[c].history) for c in range(channels)],
+                          [list(self.desc.lms[c].weights) for c in range(channels)])
+
+    def iter_frames(self):
+        """Generator to decode one frame at a time, yields a numpy view of
+        every frame's samples.
+
+        All frames get decoded into the same preallocated buffer, so a
+        yielded view gets overwritten by the next frame, copy it to keep it."""
+        frame_buf = ffi.new("short[]", python_qoa.SAMPLES_PER_FRAME * self.channels)
+        frame_samples = numpy.frombuffer(ffi.buffer(frame_buf), dtype=numpy.int16).reshape(-1, self.channels)
+        sample_index = 0
+        frame_offset = python_qoa.FIRST_FRAME_OFFSET
+
+        while sample_index < self.total_sample_count:
+            bytes_consumed, frame_len = self.decode_frame(frame_offset, frame_buf)
+            if not bytes_consumed:
+                break
+            yield frame_samples[:frame_len]
+            frame_offset += bytes_consumed
+            sample_index += frame_len
+
+    def frame_offsets(self):
+        """Walk the frame headers, return the offset of every frame."""
+        offsets = []
+        sample_index = 0
+        frame_offset = python_qoa.FIRST_FRAME_OFFSET
+
+        while sample_index < self.total_sample_count:
+            # frame header is u8 channels, u24 samplerate, u16 fsamples, u16 fsize
+            fsamples = int.from_bytes(self.buf[frame_offset + 4:frame_offset + 6], "big")
+            fsize = int.from_bytes(self.buf[frame_offset + 6:frame_offset + 8], "big")
+            if not fsize:
+                break
+            offsets.append(frame_offset)
+            frame_offset += fsize
+            sample_index += fsamples
+        return offsets
+
+    def decode_frames(self, frame_offsets, dest):
+        """Decode the consecutive frames at frame_offsets into the numpy
+        array dest. Returns the amount of samples written to dest."""
+        sample_index = 0
+        for frame_offset in frame_offsets:
+            dest_samples = ffi.from_buffer("short[]", dest[sample_index:], require_writable=True)
+            sample_index += self.decode_frame(frame_offset, dest_samples)[1]
+        return sample_index
 
     @property
     def max_frame_size(self):
         return lib.qoa_max_frame_size(self.desc)
 
-    def c_decode(self, _check_against=None):
-        ret = lib.qoa_decode(self.b, len(self.b), self.desc)
+    def c_decode(self, _check_against=None, workers=None):
+        if self.trace is not None and not workers:
+            # qoa_decode() does the whole file at once, go one frame at a
+            # time so there's something to trace
+            samples = numpy.empty((self.total_sample_count, self.channels), numpy.int16)
+            self.decode_frames(self.frame_index(), samples)
+            return samples
+
+        if workers:
+            samples = numpy.empty((self.total_sample_count, self.channels), numpy.int16)
+            self.decode_parallel(samples, workers)
+            if _check_against is not None:
+                assert (_check_against[:len(samples)] == samples).all()
+            return samples
+
+        ret = lib.qoa_decode(self.src, len(self.buf), self.desc)
         # return ffi.gc(ret, lib.free, size=total_samples*ffi.sizeof("short"))
         total_samples = self.desc.channels * self.desc.samples
         buf = ffi.gc(ffi.cast(f"short[{total_samples}]", ret), lib.free)
@@ -81,6 +215,97 @@ class Decoder():
     def __repr__(self):
         return f"Decode(desc={qoa_to_dict(self.desc)})"
 
+class Encoder():
+    """Encodes with qoa_encode_frame(), a frame at a time.
+
+    Samples go to C as they are, without a copy, as long as they're C
+    contiguous int16. Every frame gets encoded into the same preallocated
+    buffer and the LMS state carries over in self.desc from one call to
+    the next, so encoding a long capture takes fixed memory."""
+
+    def __init__(self, channels, samplerate, total_sample_count):
+        assert 0 < channels <= QOA_MAX_CHANNELS and 0 < samplerate <= 0xffffff and total_sample_count > 0
+        self.channels = channels
+        self.desc = ffi.new("qoa_desc *", dict(channels=channels, samplerate=samplerate, samples=total_sample_count))
+        self.total_sample_count = total_sample_count
+        self.sample_count = 0 # encoded so far
+
+        # like qoa_encode()
+        for c in range(channels):
+            self.desc.lms[c].history = [0, 0, 0, 0]
+            self.desc.lms[c].weights = [0, 0, -(1 << 13), 1 << 14]
+
+        self.frame_buf = ffi.new("unsigned char[]", lib.qoa_max_frame_size(self.desc))
+        self.frame = memoryview(ffi.buffer(self.frame_buf))
+        # samples of a frame that isn't complete yet, see iter_encode()
+        self.pending = numpy.empty((python_qoa.SAMPLES_PER_FRAME, channels), numpy.int16)
+        self.pending_count = 0
+
+    def encode_header(self):
+        header = ffi.new("unsigned char[]", python_qoa.FIRST_FRAME_OFFSET)
+        assert lib.qoa_encode_header(self.desc, header) == python_qoa.FIRST_FRAME_OFFSET
+        return bytes(ffi.buffer(header))
+
+    def encode_frame(self, samples):
+        """Encode up to SAMPLES_PER_FRAME samples, shaped (frame_len,
+        channels), into a frame. Only the last one may be short.
+
+        Returns a view of the frame buffer, it gets overwritten by the next
+        frame, copy it to keep it."""
+        frame_len = len(samples)
+        assert samples.shape[1:] == (self.channels,)
+        assert 0 < frame_len <= python_qoa.SAMPLES_PER_FRAME
+        assert frame_len == python_qoa.SAMPLES_PER_FRAME or self.sample_count + frame_len == self.total_sample_count, \
+            "only the last frame may be short"
+
+        # only copies if it has to
+        samples = numpy.ascontiguousarray(samples, numpy.int16)
+        size = lib.qoa_encode_frame(ffi.from_buffer("short[]", samples), self.desc, frame_len, self.frame_buf)
+        assert size == python_qoa.frame_size(self.channels, math.ceil(frame_len / python_qoa.QOA_SLICE_LEN))
+        self.sample_count += frame_len
+        return self.frame[:size]
+
+    def iter_encode(self, chunks):
+        """Generator to encode chunks of samples shaped (n, channels), of
+        any length, as they come. Yields the file header, then a view of
+        every frame as soon as there's enough samples for it, just like
+        encode_frame(). Write them out before going on to the next one.
+
+        Whole frames are encoded straight from the chunks, only the ones
+        spanning chunks get copied together first."""
+        yield self.encode_header()
+        for chunk in chunks:
+            chunk = numpy.asarray(chunk, numpy.int16).reshape(-1, self.channels)
+            i = 0
+            if self.pending_count:
+                i = min(python_qoa.SAMPLES_PER_FRAME - self.pending_count, len(chunk))
+                self.pending[self.pending_count:self.pending_count + i] = chunk[:i]
+                self.pending_count += i
+                if self.pending_count < python_qoa.SAMPLES_PER_FRAME:
+                    continue
+                yield self.encode_frame(self.pending)
+                self.pending_count = 0
+
+            for i in range(i, len(chunk), python_qoa.SAMPLES_PER_FRAME):
+                frame = chunk[i:i + python_qoa.SAMPLES_PER_FRAME]
+                if len(frame) < python_qoa.SAMPLES_PER_FRAME:
+                    self.pending[:len(frame)] = frame
+                    self.pending_count = len(frame)
+                    break
+                yield self.encode_frame(frame)
+
+        if self.pending_count:
+            yield self.encode_frame(self.pending[:self.pending_count])
+            self.pending_count = 0
+        assert self.sample_count == self.total_sample_count, \
+            f"got {self.sample_count} samples, the header says {self.total_sample_count}"
+
+    @classmethod
+    def encode(cls, samples, samplerate):
+        """Encode a whole numpy array shaped (samples, channels)."""
+        self = cls(samples.shape[1], samplerate, len(samples))
+        return b"".join(bytes(frame) for frame in self.iter_encode([samples]))
+
 if __name__ == "__main__":
     d = Decode(open("../samples/allegaeon-beasts-and-worms.qoa", "br").read())
     buf = d.decode()
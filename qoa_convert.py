@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+
+"""Batch convert qoa files to wav.
+
+Takes qoa files, or directories to find them in, and decodes them with the
+implementation picked with -i (same as test/qoa_test.py). Files are spread over
+a process pool, each one is written a frame at a time as it gets decoded,
+so a worker only ever holds one frame of samples."""
+
+import argparse
+import concurrent.futures
+import os
+import pathlib
+import sys
+import time
+import wave
+
+sys.path.append(str((pathlib.Path(__file__)/"../python").resolve()))
+from implementations import add_implementation_argument, import_implementation
+
+def find_inputs(paths):
+    """(qoa file, directory it was found in) for every path, directories
+    get searched recursively."""
+    for path in paths:
+        if path.is_dir():
+            for qoa_file in sorted(path.rglob("*.qoa")):
+                yield qoa_file, path
+        else:
+            yield path, path.parent
+
+def output_path(qoa_file, root, output_dir):
+    """Next to qoa_file, or in the same place under output_dir as it is under root."""
+    if output_dir is None:
+        return qoa_file.with_suffix(".wav")
+    return (output_dir/qoa_file.relative_to(root)).with_suffix(".wav")
+
+def iter_samples(d, mode):
+    """Samples of every frame, whatever else iter_frames() yields along."""
+    kwargs = {} if mode is None else dict(mode=mode)
+    for frame in d.iter_frames(**kwargs):
+        yield frame[0] if isinstance(frame, tuple) else frame
+
+def convert(implementation, qoa_file, wav_file, mode=None):
+    """Runs in a pool worker, returns the amount of samples written."""
+    module = import_implementation(implementation)
+    d = module.Decoder.from_file(qoa_file)
+    d.decode_header()
+
+    wav_file.parent.mkdir(parents=True, exist_ok=True)
+    # no half written wav files if anything goes wrong
+    tmp = wav_file.with_name(f"{wav_file.name}.{os.getpid()}.tmp")
+    try:
+        with wave.open(str(tmp), "wb") as w:
+            w.setnchannels(d.channels)
+            w.setsampwidth(2)
+            w.setframerate(d.samplerate)
+            w.setnframes(d.total_sample_count)
+            sample_count = 0
+            for samples in iter_samples(d, mode):
+                assert samples.shape[1] == d.channels, "wav can't change channels midway"
+                w.writeframesraw(samples.astype("<i2").tobytes())
+                sample_count += len(samples)
+        assert sample_count == d.total_sample_count, \
+            f"got {sample_count} samples, the header says {d.total_sample_count}"
+        os.replace(tmp, wav_file)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return sample_count
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    add_implementation_argument(parser)
+    parser.add_argument("paths", nargs="+", type=pathlib.Path, help="qoa files or directories of them")
+    parser.add_argument("-o", "--output-dir", type=pathlib.Path,
+                        help="write the wav files here instead of next to the qoa ones")
+    parser.add_argument("--mode", help="decode mode, fast if the implementation has it, see FRAME_MODES")
+    parser.add_argument("--workers", type=int, default=None, help="processes, one per core by default")
+    parser.add_argument("--overwrite", action="store_true", help="also convert files that already have a wav")
+    args = parser.parse_args()
+
+    # only the modes that go a frame at a time, checked once instead of
+    # failing every file
+    modes = getattr(import_implementation(args.implementation).Decoder, "FRAME_MODES", ())
+    if args.mode is None and "fast" in modes:
+        args.mode = "fast"
+    if args.mode is not None and args.mode not in modes:
+        parser.error(f"{args.implementation} can't decode a frame at a time with --mode {args.mode}, "
+                     f"only with {', '.join(modes) or 'no --mode'}")
+
+    jobs = {}
+    for qoa_file, root in find_inputs(args.paths):
+        wav_file = output_path(qoa_file, root, args.output_dir)
+        if wav_file.exists() and not args.overwrite:
+            print(f"skipping {qoa_file}, {wav_file} already exists")
+            continue
+        jobs[qoa_file] = wav_file
+
+    start = time.perf_counter()
+    samples = 0
+    failures = 0
+    with concurrent.futures.ProcessPoolExecutor(args.workers) as pool:
+        futures = {
+            pool.submit(convert, args.implementation, qoa_file, wav_file, args.mode): qoa_file
+            for qoa_file, wav_file in jobs.items()
+        }
+        for future in concurrent.futures.as_completed(futures):
+            qoa_file = futures[future]
+            try:
+                samples += future.result()
+                print(f"{qoa_file} => {jobs[qoa_file]}")
+            except Exception as e:
+                failures += 1
+                print(f"FAILED {qoa_file}: {e!r}")
+    seconds = time.perf_counter() - start
+
+    print(f"{len(jobs) - failures} files converted, {failures} failed, {samples / seconds:.0f} samples/s")
+    sys.exit(1 if failures else 0)
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+
+"""Benchmarks for qoa implementations.
+
+Runs the LMS microbenchmarks and full file decodes of the implementations
+picked with -i (same as qoa_test.py, repeat it for more than one). Every
+benchmark gets a fresh process, so the peak RSS reported is its own."""
+
+import argparse
+import concurrent.futures
+import json
+import logging
+import multiprocessing
+import numpy
+import pathlib
+import platform
+import resource
+import sys
+import time
+
+import qoa_test
+
+# what --baseline compares, higher is better
+METRICS = {
+    "lms": "updates_per_sec",
+    "decode": "samples_per_sec",
+}
+
+def peak_rss_mib():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def bench_lms(module, updates):
+    """predict() and update() one sample at a time, like a decoder does,
+    for every LMS variant of the implementation."""
+    if not hasattr(module, "Lms"):
+        return []
+    variants = module.Lms.variants() if hasattr(module.Lms, "variants") else [module.Lms]
+    residuals = numpy.random.default_rng(0).integers(-1024, 1024, updates).tolist()
+
+    results = []
+    for lms in variants:
+        l = lms.load(history=[0, 0, 0, 0], weights=[0, 0, -(1 << 13), 1 << 14])
+        start = time.perf_counter()
+        for residual in residuals:
+            sample = min(max(l.predict() + residual, -32768), 32767)
+            l.update(sample, residual)
+        seconds = time.perf_counter() - start
+
+        result = dict(
+            variant=lms.__name__,
+            updates=updates,
+            seconds=seconds,
+            updates_per_sec=updates / seconds,
+        )
+        if hasattr(l, "stats"):
+            result["clocks_per_update"] = l.stats()["cycles"] / updates
+        results.append(result)
+    return results
+
+def frame_latencies(module, qoa_file, frames, mode=None):
+    """How long each of the first frames takes to come out of iter_frames()."""
+    latencies = []
+    kwargs = {} if mode is None else dict(mode=mode)
+    it = module.Decoder.from_file(qoa_file).iter_frames(**kwargs)
+    while len(latencies) < frames:
+        start = time.perf_counter()
+        try:
+            next(it)
+        except StopIteration:
+            break
+        latencies.append(time.perf_counter() - start)
+    return numpy.array(latencies) * 1000
+
+def bench_decode(module, qoa_file, repeat, latency_frames, mode=None):
+    """decode() the whole file, the best of repeat runs."""
+    d = module.Decoder.from_file(qoa_file)
+    d.decode_header()
+    kwargs = {} if mode is None else dict(mode=mode)
+    seconds = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        d.decode(**kwargs)
+        seconds = min(seconds, time.perf_counter() - start)
+
+    samples = d.total_sample_count * d.channels
+    result = dict(
+        sample=qoa_file.stem,
+        mode=mode,
+        channels=d.channels,
+        samplerate=d.samplerate,
+        samples=samples,
+        seconds=seconds,
+        samples_per_sec=samples / seconds,
+        realtime_factor=d.total_sample_count / d.samplerate / seconds,
+    )
+    # hardware implementations know how many clocks that took
+    if hasattr(d, "samples_per_clock"):
+        result["samples_per_clock"] = d.samples_per_clock()
+
+    # only some modes can go a frame at a time
+    frame_mode = mode is None or mode in getattr(module.Decoder, "FRAME_MODES", ())
+    if hasattr(module.Decoder, "iter_frames") and latency_frames and frame_mode:
+        ms = frame_latencies(module, qoa_file, latency_frames, mode)
+        result["frame_latency_ms"] = dict(
+            frames=len(ms),
+            p50=numpy.percentile(ms, 50),
+            p90=numpy.percentile(ms, 90),
+            p99=numpy.percentile(ms, 99),
+            max=ms.max(),
+        )
+    return [result]
+
+def decode_modes(implementation, wanted):
+    """The MODES of the implementation's Decoder that are in wanted."""
+    modes = getattr(qoa_test.import_implementation(implementation).Decoder, "MODES", (None,))
+    return [mode for mode in modes if not wanted or mode is None or mode in wanted]
+
+def run_benchmark(implementation, suite, args, mode=None):
+    """Runs in its own process, see run()."""
+    # measure the decoding, not the terminal
+    logging.disable(logging.INFO)
+    module = qoa_test.import_implementation(implementation)
+    if suite == "lms":
+        results = bench_lms(module, args.updates)
+    else:
+        results = bench_decode(module, args.sample, args.repeat, args.latency_frames, mode)
+    for result in results:
+        result.update(implementation=implementation, suite=suite, peak_rss_mib=peak_rss_mib())
+    return results
+
+def run(implementation, suite, args, mode=None):
+    with concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context("spawn")) as pool:
+        return pool.submit(run_benchmark, implementation, suite, args, mode).result()
+
+def key(result):
+    k = result["implementation"], result["suite"], result.get("sample", result.get("variant"))
+    return k + (result["mode"],) if result.get("mode") else k
+
+def regressions(results, baseline, tolerance):
+    """Results worse than in baseline by more than tolerance."""
+    baseline = {key(b): b for b in baseline["results"]}
+    for result in results:
+        metric = METRICS[result["suite"]]
+        b = baseline.get(key(result))
+        if b is not None and result[metric] < b[metric] * (1 - tolerance):
+            yield f"{'/'.join(key(result))}: {metric} {result[metric]:.0f} < {b[metric]:.0f} in the baseline"
+
+def describe(result):
+    name = "/".join(key(result))
+    if result["suite"] == "lms":
+        line = f"{name}: {result['updates_per_sec']:.0f} updates/s"
+        if "clocks_per_update" in result:
+            line += f", {result['clocks_per_update']:.2f} clocks/update"
+    else:
+        line = f"{name}: {result['samples_per_sec']:.0f} samples/s, {result['realtime_factor']:.2f}x real time"
+        if result["realtime_factor"] < 1:
+            line += " (too slow for real time)"
+        if "samples_per_clock" in result:
+            line += f", {result['samples_per_clock']:.3f} samples/clock"
+        if "frame_latency_ms" in result:
+            latency = result["frame_latency_ms"]
+            line += f", frame latency p50={latency['p50']:.2f}ms p99={latency['p99']:.2f}ms max={latency['max']:.2f}ms"
+    return line + f", {result['peak_rss_mib']:.0f} MiB peak RSS"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__)
+    qoa_test.add_implementation_argument(parser, action="append", default=None)
+    parser.add_argument("samples", nargs="*", type=pathlib.Path,
+                        help="qoa files to decode, all of samples/ by default")
+    parser.add_argument("--suite", choices=["lms", "decode", "all"], default="all")
+    parser.add_argument("--updates", type=int, default=100000, help="per LMS benchmark")
+    parser.add_argument("--mode", action="append",
+                        help="decode modes to benchmark, all of the Decoder's MODES by default")
+    parser.add_argument("--repeat", type=int, default=1, help="decodes per file, the best one counts")
+    parser.add_argument("--latency-frames", type=int, default=16, help="frames to measure the latency of")
+    parser.add_argument("--json", type=pathlib.Path, help="write the results here")
+    parser.add_argument("--baseline", type=pathlib.Path, help="fail if worse than the results in this --json")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="how much worse than --baseline is fine")
+    args = parser.parse_args()
+    implementations = args.implementation or ["python_qoa"]
+    samples = args.samples or sorted(qoa_test.SAMPLES.glob("*.qoa"))
+
+    results = []
+    for implementation in implementations:
+        if args.suite in ("lms", "all"):
+            for result in run(implementation, "lms", args):
+                print(describe(result))
+                results.append(result)
+        if args.suite in ("decode", "all"):
+            for args.sample in samples:
+                for mode in decode_modes(implementation, args.mode):
+                    for result in run(implementation, "decode", args, mode):
+                        print(describe(result))
+                        results.append(result)
+
+    if args.json:
+        args.json.write_text(json.dumps(dict(
+            python=sys.version,
+            machine=platform.machine(),
+            time=time.time(),
+            results=results,
+        ), indent=4))
+
+    if args.baseline:
+        failures = list(regressions(results, json.loads(args.baseline.read_text()), args.tolerance))
+        for failure in failures:
+            print("REGRESSION", failure)
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+"""Differential fuzzer for qoa implementations.
+
+Generates batches of random LMS states, slices and whole frames, runs them
+through the implementations picked with -i (same as qoa_test.py, repeat it
+for more than one) and compares the results in bulk:
+* --level lms: every implementation's Lms against the spec, predicting and
+  updating one slice worth of samples from a random state.
+* --level frame: files of random frames decoded by every implementation,
+  in every mode, with its Decoder and FrameDecoder if it has one, against
+  the first -i.
+
+Batches are spread over worker processes. Any mismatch gets shrunk to a
+minimal reproducer, written to --out, and the exit code is 1.
+
+Cases whose prediction leaves 32 bits at any point are thrown away, qoa.h
+doesn't define what happens then. Implementations declaring WEIGHT_BITS
+(the verilog keeps 16 bit weights, see the TODO in lms.sv) are only held
+to the cases whose weights stay in that range, everyone else gets
+compared on all of them. Both kinds of skipped cases get counted."""
+
+import argparse
+import collections
+import concurrent.futures
+import inspect
+import json
+import logging
+import numpy
+import pathlib
+import sys
+import time
+
+import qoa_test
+
+python_qoa = qoa_test.import_implementation("python_qoa")
+SLICE_LEN = python_qoa.QOA_SLICE_LEN
+MAX_SLICES = python_qoa.MAX_SLICES_PER_FRAME
+
+def random_lms_states(rng, shape):
+    """history and weights, shaped (*shape, 4). Weights are mostly
+    small, like the ones an encoder ends up with, some anywhere in 16 bits
+    so a few of them grow out of it."""
+    history = rng.integers(-32768, 32768, (*shape, 4))
+    weights = numpy.clip(rng.normal(0, 4096, (*shape, 4)), -32768, 32767).astype(numpy.int64)
+    anywhere = rng.random(shape) < 0.1
+    weights[anywhere] = rng.integers(-32768, 32768, (anywhere.sum(), 4))
+    return history, weights
+
+def random_slices(rng, shape):
+    """Random slices as uint64, scalefactors biased towards the small
+    ones audio mostly needs."""
+    scalefactors = numpy.minimum(rng.geometric(0.3, shape) - 1, 15).astype(numpy.uint64)
+    qr = rng.integers(0, 8, (*shape, SLICE_LEN), dtype=numpy.uint64)
+    # the fields don't overlap, so the sum is the same as or-ing them
+    return (scalefactors << numpy.uint64(60)) | (qr << python_qoa.QR_SHIFTS).sum(axis=-1, dtype=numpy.uint64)
+
+def dequantize(slices):
+    """(..., slices) => (..., slices * SLICE_LEN) dequantized residuals"""
+    scalefactors = (slices >> numpy.uint64(60)).astype(numpy.intp)
+    qr = ((slices[..., None] >> python_qoa.QR_SHIFTS) & numpy.uint64(0b111)).astype(numpy.intp)
+    residuals = python_qoa.DEQUANT_ARRAY[scalefactors[..., None], qr].astype(numpy.int64)
+    return residuals.reshape(*slices.shape[:-1], -1)
+
+def lms_model(history, weights, residuals):
+    """The spec's LMS in int64, stepping every leading index at once.
+
+    residuals are (..., n) already dequantized. Returns the samples and
+    predictions, both (..., n), which cases kept their prediction in 32
+    bits and the peak of the weights of every case, see comparable()."""
+    history = history.copy()
+    weights = weights.copy()
+    samples = numpy.empty(residuals.shape, numpy.int64)
+    predictions = numpy.empty(residuals.shape, numpy.int64)
+    valid = numpy.ones(residuals.shape[:-1], bool)
+    peak_weights = numpy.maximum(weights, -weights - 1).max(axis=-1)
+
+    for i in range(residuals.shape[-1]):
+        prediction = (history * weights).sum(axis=-1) # in spec [4]
+        valid &= (-(1 << 31) <= prediction) & (prediction < (1 << 31))
+        predictions[..., i] = prediction >> 13
+        samples[..., i] = numpy.clip(predictions[..., i] + residuals[..., i], -32768, 32767) # in spec [5]
+
+        delta = (residuals[..., i] >> 4)[..., None]
+        weights += numpy.where(history < 0, -delta, delta) # in spec [6]
+        peak_weights = numpy.maximum(peak_weights, numpy.maximum(weights, -weights - 1).max(axis=-1))
+        history[..., :-1] = history[..., 1:] # in spec [7]
+        history[..., -1] = samples[..., i]
+    return samples, predictions, valid, peak_weights
+
+def comparable(cls, valid, peak_weights):
+    """The valid cases cls can be held to: all of them, unless it
+    declares WEIGHT_BITS, then only the ones whose weights fit."""
+    bits = getattr(cls, "WEIGHT_BITS", None)
+    return valid if bits is None else valid & (peak_weights < (1 << (bits - 1)))
+
+def qoa_bytes(history, weights, slices, samplerate=44100):
+    """A qoa file of frames with history, weights (frames, channels, 4)
+    and slices (frames, slices, channels), every frame the same size."""
+    frames, slice_count, channels = slices.shape
+    fsamples = slice_count * SLICE_LEN
+    frame_header = python_qoa.FRAME_HEADER_STRUCT.pack(
+        channels, samplerate.to_bytes(3, "big"), fsamples,
+        python_qoa.frame_size(channels, slice_count))
+
+    parts = [python_qoa.FILE_HEADER_STRUCT.pack(python_qoa.MAGIC, frames * fsamples)]
+    for f in range(frames):
+        parts.append(frame_header)
+        parts.append(numpy.stack([history[f], weights[f]], axis=1).astype(">i2").tobytes())
+        parts.append(slices[f].astype(python_qoa.SLICE_DTYPE).tobytes())
+    return b"".join(parts)
+
+_modules = {}
+def implementation(name):
+    if name not in _modules:
+        _modules[name] = qoa_test.import_implementation(name)
+    return _modules[name]
+
+def decoder_classes(name):
+    """name's Decoder, and FrameDecoder if it has one, by label."""
+    module = implementation(name)
+    classes = {name: module.Decoder}
+    if hasattr(module, "FrameDecoder"):
+        classes[f"{name}.FrameDecoder"] = module.FrameDecoder
+    return classes
+
+def decode(label, decoder, data):
+    """Decode a whole file from bytes in every one of decoder's MODES.
+    Returns {label/mode: samples}."""
+    if "encoded_bytes" in inspect.signature(decoder).parameters:
+        d = decoder(data)
+    else:
+        d = decoder()
+        d.buf = memoryview(data)
+    modes = getattr(decoder, "MODES", None)
+    if modes is None:
+        return {label: d.decode()}
+    return {f"{label}/{mode}": d.decode(mode=mode) for mode in modes}
+
+def decode_all(names, data):
+    """decode() data with every decoder class of every name, as
+    (decoder class, label, samples)."""
+    return [
+        (decoder, label, samples)
+        for name in names
+        for decoder_label, decoder in decoder_classes(name).items()
+        for label, samples in decode(decoder_label, decoder, data).items()
+    ]
+
+def wrong_samples(names, history, weights, slices):
+    """Where decoding frames (see qoa_bytes()) with every decoder class,
+    in every mode, of every name differs from the first one. Frames whose weights don't fit an
+    implementation's WEIGHT_BITS aren't compared for it."""
+    _, _, valid, peak_weights = lms_model(history, weights, dequantize(slices.transpose(0, 2, 1)))
+    valid, peak_weights = valid.all(axis=-1), peak_weights.max(axis=-1)
+    assert valid.all(), "only frames with 32 bit predictions decode the same everywhere"
+    fsamples = slices.shape[1] * SLICE_LEN
+
+    decoded = [
+        (comparable(decoder, valid, peak_weights), samples)
+        for decoder, _, samples in decode_all(names, qoa_bytes(history, weights, slices))
+    ]
+    first_ok, first = decoded[0]
+    wrong = numpy.zeros(first.shape, bool)
+    for ok, samples in decoded[1:]:
+        wrong |= numpy.repeat(first_ok & ok, fsamples)[:, None] & (samples != first)
+    return wrong
+
+def run_lms(name, history, weights, samples, residuals):
+    """Predictions of name's Lms, fed the samples and residuals of every case."""
+    lms = implementation(name).Lms
+    predictions = numpy.empty(residuals.shape, numpy.int64)
+    for i in range(len(residuals)):
+        l = lms.load(history=history[i].tolist(), weights=weights[i].tolist())
+        if hasattr(l, "predict_and_update"):
+            predictions[i] = l.predict_and_update(samples[i], residuals[i])
+            continue
+        for j, (sample, residual) in enumerate(zip(samples[i].tolist(), residuals[i].tolist())):
+            predictions[i, j] = l.predict()
+            l.update(sample, residual)
+    return predictions
+
+def shrink_lms(name, history, weights, residuals):
+    """Smallest case that still predicts differently from the spec."""
+    def mismatch(history, weights, residuals):
+        samples, predictions, valid, peak_weights = lms_model(history[None], weights[None], residuals[None])
+        return (comparable(implementation(name).Lms, valid, peak_weights)[0]
+                and (run_lms(name, history[None], weights[None], samples, residuals[None]) != predictions).any())
+
+    samples, predictions, _, _ = lms_model(history[None], weights[None], residuals[None])
+    wrong = run_lms(name, history[None], weights[None], samples, residuals[None]) != predictions
+    residuals = residuals[:numpy.argmax(wrong[0]) + 1]
+    # residuals can't be 0, see DEQUANT_TAB, so only the state shrinks
+    for state in (history, weights):
+        for i in range(len(state)):
+            if state[i]:
+                old, state[i] = state[i], 0
+                if not mismatch(history, weights, residuals):
+                    state[i] = old
+    samples, predictions, _, _ = lms_model(history[None], weights[None], residuals[None])
+    return dict(
+        level="lms",
+        implementation=name,
+        history=history.tolist(),
+        weights=weights.tolist(),
+        residuals=residuals.tolist(),
+        expected_predictions=predictions[0].tolist(),
+        predictions=run_lms(name, history[None], weights[None], samples, residuals[None])[0].tolist(),
+    )
+
+def fuzz_lms(names, seed, cases):
+    """Returns the counts of cases compared and skipped, and the shrunk
+    mismatches."""
+    rng = numpy.random.default_rng(seed)
+    history, weights = random_lms_states(rng, (cases,))
+    residuals = dequantize(random_slices(rng, (cases, 1)))
+    samples, predictions, valid, peak_weights = lms_model(history, weights, residuals)
+    counts = collections.Counter({
+        "lms": int(valid.sum()),
+        "lms skipped, predictions over 32 bits": int((~valid).sum()),
+    })
+
+    mismatches = []
+    for name in names:
+        lms = implementation(name).Lms
+        ok = comparable(lms, valid, peak_weights)
+        if (valid & ~ok).any():
+            counts[f"lms skipped for {name}, weights over {lms.WEIGHT_BITS} bits"] += int((valid & ~ok).sum())
+        cases = numpy.flatnonzero(ok)
+        wrong = (run_lms(name, history[cases], weights[cases], samples[cases], residuals[cases]) != predictions[cases]).any(axis=-1)
+        if wrong.any():
+            i = cases[numpy.argmax(wrong)]
+            mismatches.append(shrink_lms(name, history[i].copy(), weights[i].copy(), residuals[i].copy()))
+    return counts, mismatches
+
+def frame_mismatch(names, history, weights, slices):
+    """Where decoding the single frame file differs between names, if valid."""
+    _, _, valid, _ = lms_model(history, weights, dequantize(slices.T))
+    if not valid.all():
+        return None
+    wrong = wrong_samples(names, history[None], weights[None], slices[None])
+    return wrong if wrong.any() else None
+
+def shrink_frame(names, history, weights, slices):
+    """Smallest single frame that still decodes differently."""
+    # only what comes before the first wrong sample matters
+    wrong = frame_mismatch(names, history, weights, slices)
+    slices = slices[:numpy.argmax(wrong.any(axis=-1)) // SLICE_LEN + 1]
+
+    for ch in reversed(range(slices.shape[1])):
+        if slices.shape[1] > 1:
+            keep = [c for c in range(slices.shape[1]) if c != ch]
+            if frame_mismatch(names, history[keep], weights[keep], slices[:, keep]) is not None:
+                history, weights, slices = history[keep], weights[keep], slices[:, keep]
+
+    for state in (history, weights, slices):
+        for i in numpy.ndindex(state.shape):
+            if state[i]:
+                old, state[i] = state[i], 0
+                if frame_mismatch(names, history, weights, slices) is None:
+                    state[i] = old
+
+    data = qoa_bytes(history[None], weights[None], slices[None])
+    return dict(
+        level="frame",
+        implementations=names,
+        qoa=data.hex(),
+        decoded={label: samples.tolist() for _, label, samples in decode_all(names, data)},
+    )
+
+def fuzz_frames(names, seed, frames):
+    """Returns the counts of slices decoded and skipped, and the shrunk
+    mismatches."""
+    rng = numpy.random.default_rng(seed)
+    channels = int(rng.integers(1, 9))
+    history, weights = random_lms_states(rng, (frames, channels))
+    slices = random_slices(rng, (frames, MAX_SLICES, channels))
+    _, _, valid, peak_weights = lms_model(history, weights, dequantize(slices.transpose(0, 2, 1)))
+    valid, peak_weights = valid.all(axis=-1), peak_weights.max(axis=-1)
+    frame_slices = MAX_SLICES * channels
+    counts = collections.Counter({
+        "frame": int(valid.sum()) * frame_slices,
+        "frame skipped, predictions over 32 bits": int((~valid).sum()) * frame_slices,
+    })
+    for name in names:
+        for label, decoder in decoder_classes(name).items():
+            skipped = int((valid & ~comparable(decoder, valid, peak_weights)).sum())
+            if skipped:
+                counts[f"frame skipped for {label}, weights over {decoder.WEIGHT_BITS} bits"] += skipped * frame_slices
+
+    history, weights, slices = history[valid], weights[valid], slices[valid]
+    if not len(slices):
+        return counts, []
+
+    mismatches = []
+    wrong = wrong_samples(names, history, weights, slices)
+    if wrong.any():
+        f = numpy.argmax(wrong.any(axis=-1)) // (MAX_SLICES * SLICE_LEN)
+        mismatches.append(shrink_frame(names, history[f].copy(), weights[f].copy(), slices[f].copy()))
+    return counts, mismatches
+
+def init_worker():
+    logging.disable(logging.INFO)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    qoa_test.add_implementation_argument(parser, action="append", default=None)
+    parser.add_argument("--level", choices=["lms", "frame", "all"], default="all")
+    parser.add_argument("--cases", type=int, default=1000000,
+                        help="LMS states, or slices for --level frame, per level")
+    parser.add_argument("--batch", type=int, default=2000, help="LMS states per job")
+    parser.add_argument("--frames", type=int, default=16, help="frames per job")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", type=pathlib.Path, default=pathlib.Path(__file__)/"../../build/fuzz")
+    args = parser.parse_args()
+    names = args.implementation or ["reference_cffi", "python_qoa"]
+    init_worker()
+
+    jobs = []
+    if args.level in ("lms", "all"):
+        lms_names = [name for name in names if hasattr(implementation(name), "Lms")]
+        jobs += [(fuzz_lms, lms_names, args.batch)] * -(-args.cases // args.batch)
+    if args.level in ("frame", "all"):
+        slices_per_job = args.frames * MAX_SLICES * 4 # 4.5 channels on average, but some frames get thrown away
+        jobs += [(fuzz_frames, names, args.frames)] * -(-args.cases // slices_per_job)
+
+    start = time.perf_counter()
+    totals = collections.Counter()
+    mismatches = []
+    with concurrent.futures.ProcessPoolExecutor(args.workers, initializer=init_worker) as pool:
+        futures = {
+            pool.submit(fuzz, job_names, args.seed + i, size): fuzz.__name__
+            for i, (fuzz, job_names, size) in enumerate(jobs)
+        }
+        for future in concurrent.futures.as_completed(futures):
+            counts, found = future.result()
+            totals += counts
+            mismatches += found
+    seconds = time.perf_counter() - start
+
+    for what, cases in sorted(totals.items()):
+        print(f"{what}: {cases} cases")
+    compared = totals["lms"] + totals["frame"]
+    print(f"{compared / seconds:.0f} cases/s, {len(mismatches)} mismatches")
+
+    if mismatches:
+        args.out.mkdir(parents=True, exist_ok=True)
+        for i, mismatch in enumerate(mismatches):
+            path = args.out/f"{mismatch['level']}-{args.seed}-{i}.json"
+            path.write_text(json.dumps(mismatch, indent=4))
+            print(f"reproducer in {path}")
+        sys.exit(1)
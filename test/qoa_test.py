@@ -3,31 +3,170 @@
 """Multi-target test system for qoa encoders and decoders."""
 
 import argparse
+import asyncio
+import collections
+import concurrent.futures
+import gc
+import hashlib
+import inspect
+import itertools
+import logging
 import numpy
+import os
 import pathlib
+import struct
 import sys
+import tempfile
 import unittest
 import wave
+import weakref
+import zlib
+
+MODULES = (pathlib.Path(__file__)/"../../python").resolve()
+SAMPLES = (pathlib.Path(__file__)/"../../samples/").resolve()
+BUILD_DIR = (pathlib.Path(__file__)/"../../build/").resolve()
+GOLDEN = BUILD_DIR/"golden"
+CORPUS = BUILD_DIR/"corpus"
+
+sys.path.append(str(MODULES))
+from implementations import add_implementation_argument, import_implementation
+
+# name => (channels, samples per channel) of the samples synthesize() can
+# make, for whenever they're not in SAMPLES
+SYNTHETIC_SAMPLES = {
+    "synthetic-mono-tiny": (1, 7),
+    "synthetic-mono-short": (1, 16317),
+    "synthetic-stereo": (2, 20 * 44100),
+    "synthetic-stereo-long": (2, 3 * 60 * 44100),
+    "synthetic-5.1": (6, 30 * 44100),
+    "synthetic-8-channels": (8, 44100),
+}
+SYNTHETIC_SAMPLERATE = 44100
+
+DEFAULT_SAMPLE = "allegaeon-beasts-and-worms"
+if not (SAMPLES/(DEFAULT_SAMPLE+".qoa")).exists():
+    DEFAULT_SAMPLE = "synthetic-stereo"
+
+QoaHeader = collections.namedtuple("QoaHeader", "samples channels samplerate")
+
+def iter_synthesized(audio_name, chunk=1 << 20):
+    """Generator of the samples of one of SYNTHETIC_SAMPLES, in chunks
+    shaped (chunk, channels).
+
+    A few sines per channel with some noise, getting louder until it
+    clips, so all the scalefactors get some use."""
+    channels, samples = SYNTHETIC_SAMPLES[audio_name]
+    rng = numpy.random.default_rng(zlib.crc32(audio_name.encode()))
+    frequencies = rng.uniform(20, 8000, (3, channels)).astype(numpy.float32)
+    phases = rng.uniform(0, 2 * numpy.pi, (3, channels)).astype(numpy.float32)
+
+    for start in range(0, samples, chunk):
+        t = numpy.arange(start, min(start + chunk, samples), dtype=numpy.float32)[:, None]
+        audio = numpy.sin(2 * numpy.pi * frequencies[:, None] * t / SYNTHETIC_SAMPLERATE + phases[:, None]).sum(axis=0) / 3
+        audio += rng.normal(0, 0.05, audio.shape)
+        audio *= 1.5 * t / samples
+        yield numpy.clip(audio * 32767, -32768, 32767).astype(numpy.int16)
+
+def synthesize_pcm(audio_name):
+    """All the samples of one of SYNTHETIC_SAMPLES, shaped (samples, channels)."""
+    return numpy.concatenate(list(iter_synthesized(audio_name)))
+
+def synthesize(audio_name):
+    """Encode one of SYNTHETIC_SAMPLES with the reference into CORPUS, a
+    chunk at a time."""
+    channels, samples = SYNTHETIC_SAMPLES[audio_name]
+    e = import_implementation("reference_cffi").Encoder(channels, SYNTHETIC_SAMPLERATE, samples)
+    CORPUS.mkdir(parents=True, exist_ok=True)
+    path = CORPUS/(audio_name+".qoa")
+    tmp = path.with_name(f"{path.name}.{os.getpid()}.tmp")
+    with open(tmp, "wb") as f:
+        for encoded in e.iter_encode(iter_synthesized(audio_name)):
+            f.write(encoded)
+    os.replace(tmp, path)
+
+def qoa_encode(pcm, samplerate):
+    """Encode all of pcm in one go with qoa_encode() from qoa.h"""
+    reference = import_implementation("reference_cffi")
+    desc = reference.ffi.new("qoa_desc *", dict(channels=pcm.shape[1], samplerate=samplerate, samples=len(pcm)))
+    encoded_len = reference.ffi.new("unsigned int *")
+    encoded = reference.lib.qoa_encode(reference.ffi.from_buffer("short[]", pcm), desc, encoded_len)
+    assert encoded != reference.ffi.NULL
+    try:
+        return bytes(reference.ffi.buffer(encoded, encoded_len[0]))
+    finally:
+        reference.lib.free(encoded)
+
+def sample_path(audio_name):
+    """The qoa file of audio_name, synthesizing it if it's one of
+    SYNTHETIC_SAMPLES that isn't in SAMPLES."""
+    path = SAMPLES/(audio_name+".qoa")
+    if path.exists() or audio_name not in SYNTHETIC_SAMPLES:
+        return path
+    path = CORPUS/(audio_name+".qoa")
+    # SYNTHETIC_SAMPLES may have changed since
+    if not path.exists() or read_header(path)[:2] != SYNTHETIC_SAMPLES[audio_name][::-1]:
+        synthesize(audio_name)
+    return path
+
+def read_header(qoa_file):
+    with open(qoa_file, "rb") as f:
+        _, samples, channels, samplerate = struct.unpack(">4sIB3s", f.read(12))
+    return QoaHeader(samples, channels, int.from_bytes(samplerate, "big"))
+
+def golden(qoa_file):
+    """The reference's decode of qoa_file, memory mapped.
+
+    Cached in GOLDEN by the hash of qoa_file, so it's only decoded once
+    and every run after just maps the .npy in. A .decoded.wav next to
+    qoa_file is checked against before caching, so the reference isn't
+    only ever compared to itself."""
+    qoa_file = pathlib.Path(qoa_file)
+    digest = hashlib.sha256(qoa_file.read_bytes()).hexdigest()
+    npy_file = GOLDEN/f"{digest}.npy"
+    if not npy_file.exists():
+        samples = import_implementation("reference_cffi").Decoder.from_file(qoa_file).decode()
+        wav_file = qoa_file.with_suffix(".decoded.wav")
+        if wav_file.exists():
+            with wave.open(str(wav_file)) as w:
+                wav_samples = numpy.frombuffer(w.readframes(w.getnframes()), numpy.int16)
+                wav_samples = wav_samples.reshape(w.getnframes(), w.getnchannels())
+            assert samples.shape == wav_samples.shape and (samples == wav_samples).all(), \
+                f"reference decode of {qoa_file} doesn't match {wav_file}"
+        GOLDEN.mkdir(parents=True, exist_ok=True)
+        tmp = npy_file.with_name(f"{npy_file.name}.{os.getpid()}.tmp")
+        with open(tmp, "wb") as f:
+            numpy.save(f, samples)
+        os.replace(tmp, npy_file)
+    return numpy.load(npy_file, mmap_mode="r")
 
 class QoaTest(unittest.TestCase):
+    @staticmethod
+    def lms_variants():
+        """Implementations with several LMS datapaths list them in Lms.variants()."""
+        if hasattr(module.Lms, "variants"):
+            return module.Lms.variants()
+        return [module.Lms]
+
     def test_lms_history(self, samples=[32767, -100, 100, -32768]):
         """LMS should update history properly."""
-        l = module.Lms.load(
-            history=[0, 0, 0, 0],
-            weights=[0, 0, 0, 0]
-        )
+        for lms in self.lms_variants():
+            with self.subTest(lms=lms.__name__):
+                l = lms.load(
+                    history=[0, 0, 0, 0],
+                    weights=[0, 0, 0, 0]
+                )
 
-        for sample in samples:
-            l.update(
-                sample,
-                residual=0, # not testing this
-            )
+                for sample in samples:
+                    l.update(
+                        sample,
+                        residual=0, # not testing this
+                    )
 
-        assert list(l.history) == samples
+                assert list(l.history) == samples
 
-    def conduct_lms_predict_test(self, history, weights, update=None, post_predict=None, pre_predict=None):
+    def conduct_lms_predict_test(self, history, weights, update=None, post_predict=None, pre_predict=None, lms=None):
         """LMS should predict properly and update weights correctly."""
-        l = module.Lms.load(history=history, weights=weights)
+        l = (lms or module.Lms).load(history=history, weights=weights)
 
         if pre_predict is not None:
             assert l.predict() == pre_predict
@@ -52,39 +191,336 @@ class QoaTest(unittest.TestCase):
             # TODO: more to follow
         }
         for name, test in tests.items():
-            with self.subTest(name):
-                self.conduct_lms_predict_test(**test)
+            for lms in self.lms_variants():
+                with self.subTest(name, lms=lms.__name__):
+                    self.conduct_lms_predict_test(**test, lms=lms)
+
+    def test_lms_threads(self, instances=4, updates=2000):
+        """LMS instances should be independent of each other, also when
+        they run at the same time from different threads."""
+        if not hasattr(module, "Lms"):
+            self.skipTest(f"{module.__name__} has no Lms")
+        residuals = numpy.random.default_rng(0).integers(-1024, 1024, (instances, updates)).tolist()
+
+        def run(lms, residuals):
+            l = lms.load(history=[0, 0, 0, 0], weights=[0, 0, -(1 << 13), 1 << 14])
+            predictions = []
+            for residual in residuals:
+                predictions.append(l.predict())
+                l.update(min(max(predictions[-1] + residual, -32768), 32767), residual)
+            return predictions, list(l.history), list(l.weights)
+
+        for lms in self.lms_variants():
+            with self.subTest(lms=lms.__name__):
+                expected = [run(lms, r) for r in residuals]
+                with concurrent.futures.ThreadPoolExecutor(instances) as pool:
+                    assert list(pool.map(run, [lms] * instances, residuals)) == expected
+
+    def test_pyrilator_trace(self, cycles=5):
+        """trace= builds should write their dump file and still count
+        cycles in stats()."""
+        if not hasattr(module, "pyrilate"):
+            self.skipTest(f"{module.__name__} isn't pyrilated")
+        LmsDut = module.pyrilate(module.Lms.VERILOG_PATH, build_dir=module.BUILD_DIR, trace="fst")
+        with tempfile.TemporaryDirectory() as tmp:
+            trace_file = pathlib.Path(tmp)/"lms.fst"
+            dut = LmsDut(trace_file=trace_file)
+            for _ in range(cycles):
+                dut.clk = 0
+                dut.eval()
+                dut.clk = 1
+                dut.eval()
+            stats = dut.stats()
+            dut.close()
+            assert stats["cycles"] == cycles
+            assert stats["evals"] == 2 * cycles
+            assert trace_file.stat().st_size > 0
+
+        # by default every variant and process gets its own
+        dut = LmsDut()
+        trace_file = dut.trace_file
+        dut.close()
+        trace_file.unlink()
+        assert trace_file.parent.name == "lms_trace_fst"
+        assert f".{os.getpid()}." in trace_file.name
+
+    def test_pyrilator_snapshot_apply(self, history=[1, -2, 3, -4], weights=[-100, 200, -300, 400]):
+        """apply() should write scalar and array ports in one go, and
+        snapshot() read them back, signed ones included."""
+        if not hasattr(module, "pyrilate"):
+            self.skipTest(f"{module.__name__} isn't pyrilated")
+        dut = module.Lms.LmsDut()
+        dut.apply(dict(load=1, delta=-5, load_history=history, load_weights=weights))
+        dut.clk = 0
+        dut.eval()
+        dut.clk = 1
+        dut.eval()
+
+        ports = dut.snapshot()
+        assert (ports.load, ports.delta) == (1, -5)
+        assert list(ports.load_weights) == weights
+        assert list(ports.save_history) == history
+        assert list(ports.save_weights) == weights
+
+        # a whole snapshot goes into another instance just as well
+        other = module.Lms.LmsDut()
+        other.apply(ports)
+        assert (other.load, other.delta) == (1, -5)
+        assert other.load_weights.tolist() == weights
+
+    def test_pyrilator_view_outlives_instance(self, history=[1, -2, 3, -4]):
+        """Array port views should keep their instance's model alive."""
+        if not hasattr(module, "pyrilate"):
+            self.skipTest(f"{module.__name__} isn't pyrilated")
+        dut = module.Lms.LmsDut()
+        dut.load_history = history
+        view = dut.load_history
+        instance = weakref.ref(dut)
+        del dut
+        gc.collect()
+        assert instance() is not None
+        assert view.tolist() == history
+
+        del view
+        gc.collect()
+        assert instance() is None
 
-    def test_decode_against_reference(self, audio_name="allegaeon-beasts-and-worms"):
-        w = wave.open(str(SAMPLES/(audio_name+".decoded.wav")))
-        w_bytes = w.readframes(w.getnframes())
-        w_np = numpy.frombuffer(w_bytes, dtype=numpy.int16).reshape(w.getnframes(), w.getnchannels())
+    @staticmethod
+    def load_reference(audio_name):
+        """The header of audio_name and its decode by the reference."""
+        qoa_file = sample_path(audio_name)
+        return read_header(qoa_file), golden(qoa_file)
 
-        d = module.Decoder.from_file(SAMPLES/(audio_name+".qoa"))
+    def test_decode_against_reference(self, audio_name=DEFAULT_SAMPLE):
+        header, reference = self.load_reference(audio_name)
+
+        d = module.Decoder.from_file(sample_path(audio_name))
         d.decode_header()
-        assert d.total_sample_count == w.getnframes()
-        assert d.channels == w.getnchannels()
-        assert d.samplerate == w.getframerate()
+        assert d.total_sample_count == header.samples
+        assert d.channels == header.channels
+        assert d.samplerate == header.samplerate
 
-        decoded_samples = d.decode(_check_against=w_np)
+        # implementations with more than one way to decode list them in MODES
+        for mode in getattr(module.Decoder, "MODES", (None,)):
+            with self.subTest(mode=mode):
+                kwargs = {} if mode is None else dict(mode=mode)
+                decoded_samples = d.decode(_check_against=reference, **kwargs)
 
-        assert (decoded_samples==w_np[:len(decoded_samples)]).all()
-        assert decoded_samples.shape == w_np.shape
+                assert (decoded_samples==reference[:len(decoded_samples)]).all()
+                assert decoded_samples.shape == reference.shape
 
-if __name__ == "__main__":
-    modules = (pathlib.Path(__file__)/"../../python").resolve()
+    def test_decode_parallel(self, audio_name="synthetic-8-channels", workers=2):
+        """Splitting the frames across processes, in every mode."""
+        if "workers" not in inspect.signature(module.Decoder.decode).parameters:
+            self.skipTest(f"{module.__name__} can't decode in parallel")
+        _, reference = self.load_reference(audio_name)
+        d = module.Decoder.from_file(sample_path(audio_name))
+
+        for mode in getattr(module.Decoder, "MODES", (None,)):
+            with self.subTest(mode=mode, workers=workers):
+                kwargs = {} if mode is None else dict(mode=mode)
+                decoded_samples = d.decode(_check_against=reference, workers=workers, **kwargs)
+                assert decoded_samples.shape == reference.shape
+                assert (decoded_samples == reference).all()
+
+    def test_decode_synthetic(self, edge=2 * 5120):
+        """Everything from a handful of samples to minutes, mono to 8
+        channels, against the reference. Only the start, the middle and
+        the end of the long ones, so it doesn't take minutes too."""
+        if not hasattr(module.Decoder, "decode_range"):
+            self.skipTest(f"{module.__name__} has no random access")
+        for audio_name in SYNTHETIC_SAMPLES:
+            with self.subTest(audio_name):
+                header, reference = self.load_reference(audio_name)
+                d = module.Decoder.from_file(sample_path(audio_name))
+                d.decode_header()
+                assert d.total_sample_count == header.samples
+                assert d.channels == header.channels
+                assert reference.shape == (header.samples, header.channels)
+
+                n = header.samples
+                for start, stop in [(0, edge), (n // 2 - edge // 2, n // 2 + edge // 2), (n - edge, n)]:
+                    start = max(start, 0)
+                    assert (d.decode_range(start, stop) == reference[start:stop]).all()
+
+    def test_encode_against_reference(self, audio_names=("synthetic-mono-tiny", "synthetic-mono-short", "synthetic-8-channels")):
+        """Encoders should give out the exact same bytes as qoa.h"""
+        if not hasattr(module, "Encoder"):
+            self.skipTest(f"{module.__name__} has no Encoder")
+        for audio_name in audio_names:
+            with self.subTest(audio_name):
+                pcm = synthesize_pcm(audio_name)
+                reference = qoa_encode(pcm, SYNTHETIC_SAMPLERATE)
+                encoded = module.Encoder.encode(pcm, SYNTHETIC_SAMPLERATE)
+                assert len(encoded) == len(reference)
+                assert encoded == reference
+
+    def test_encode_streaming(self, audio_name="synthetic-mono-short"):
+        """Feeding samples in odd sized chunks shouldn't change a thing."""
+        if not hasattr(getattr(module, "Encoder", None), "iter_encode"):
+            self.skipTest(f"{module.__name__} can't encode a stream")
+        pcm = synthesize_pcm(audio_name)
+        reference = qoa_encode(pcm, SYNTHETIC_SAMPLERATE)
+        for chunk in (1234, 7777):
+            with self.subTest(chunk=chunk):
+                e = module.Encoder(pcm.shape[1], SYNTHETIC_SAMPLERATE, len(pcm))
+                chunks = (pcm[i:i + chunk] for i in range(0, len(pcm), chunk))
+                # some encoders reuse their frame buffer, copy every frame
+                encoded = b"".join(bytes(frame) for frame in e.iter_encode(chunks))
+                assert encoded == reference
+
+    def test_stream_decoder(self, audio_name="synthetic-mono-short"):
+        """Feeding the file in chunks of any size should give out the same
+        samples, frame by frame."""
+        if not hasattr(module, "StreamDecoder"):
+            self.skipTest(f"{module.__name__} has no StreamDecoder")
+        _, reference = self.load_reference(audio_name)
+        encoded = sample_path(audio_name).read_bytes()
+
+        for mode, chunk in itertools.product(module.StreamDecoder.FRAME_MODES, (1, 7, 4096, len(encoded))):
+            with self.subTest(mode=mode, chunk=chunk):
+                d = module.StreamDecoder(mode)
+                frames = []
+                for i in range(0, len(encoded), chunk):
+                    frames += d.feed(encoded[i:i + chunk])
+                d.close()
+                assert all(len(samples) <= module.SAMPLES_PER_FRAME for samples in frames)
+                assert (numpy.concatenate(frames) == reference).all()
+
+    def test_stream_decoder_dynamic(self, audio_names=("synthetic-mono-short", "synthetic-8-channels")):
+        """A stream with no known length whose channels change midway."""
+        if not hasattr(module, "StreamDecoder"):
+            self.skipTest(f"{module.__name__} has no StreamDecoder")
+        # a 0 sample count file header, then every frame of the files
+        stream = module.FILE_HEADER_STRUCT.pack(module.MAGIC, 0) + b"".join(
+            sample_path(audio_name).read_bytes()[module.FIRST_FRAME_OFFSET:]
+            for audio_name in audio_names)
+
+        async def decode():
+            reader = asyncio.StreamReader()
+            reader.feed_data(stream)
+            reader.feed_eof()
+            return [samples async for samples in module.decode_stream(reader, chunk_size=1000)]
+        frames = asyncio.run(decode())
+
+        for audio_name in audio_names:
+            _, reference = self.load_reference(audio_name)
+            frame_count = -(-len(reference) // module.SAMPLES_PER_FRAME)
+            decoded_samples, frames = numpy.concatenate(frames[:frame_count]), frames[frame_count:]
+            assert decoded_samples.shape == reference.shape
+            assert (decoded_samples == reference).all()
+        assert not frames
+
+    def test_trace_against_reference(self, audio_name="synthetic-8-channels"):
+        """Traces are in the same format everywhere, the LMS state at the
+        start and end of every frame should be the same as qoa.h's."""
+        if not hasattr(module.Decoder, "trace"):
+            self.skipTest(f"{module.__name__} can't trace")
+        python_qoa = import_implementation("python_qoa")
+        reference = import_implementation("reference_cffi").Decoder.from_file(sample_path(audio_name))
+        reference.trace = python_qoa.Trace()
+        reference.decode()
 
+        d = module.Decoder.from_file(sample_path(audio_name))
+        d.trace = python_qoa.Trace(capacity=reference.trace.count + 1)
+        d.decode()
+        assert d.trace.dropped == 0
+        assert d.trace.count == reference.trace.count
+        assert not python_qoa.Trace.mismatches(d.trace.array(), reference.trace.array())
+
+    def test_trace_slices(self, audio_name="synthetic-mono-short"):
+        """Every slice of every frame, up to the capacity."""
+        if not hasattr(module, "Trace"):
+            self.skipTest(f"{module.__name__} has no Trace")
+        header, _ = self.load_reference(audio_name)
+        d = module.Decoder.from_file(sample_path(audio_name))
+        d.trace = module.Trace(capacity=300, slices=True)
+        d.decode()
+
+        slices = -(-header.samples // module.QOA_SLICE_LEN)
+        frames = -(-header.samples // module.SAMPLES_PER_FRAME)
+        records = d.trace.array()
+        assert d.trace.count + d.trace.dropped == (slices + frames) * header.channels
+        assert d.trace.count == 300
+        assert (records["offset"][:257] == module.FIRST_FRAME_OFFSET).all()
+        assert (records["slice"][:257] == numpy.arange(-1, 256)).all()
+
+    def test_frame_decoder_against_reference(self, audio_names=(DEFAULT_SAMPLE, "synthetic-8-channels")):
+        """Decoding every channel at once should work for stereo as well
+        as 8 channel files."""
+        if not hasattr(module, "FrameDecoder"):
+            self.skipTest(f"{module.__name__} has no FrameDecoder")
+        for audio_name in audio_names:
+            with self.subTest(audio_name):
+                header, reference = self.load_reference(audio_name)
+                d = module.FrameDecoder.from_file(sample_path(audio_name))
+                decoded_samples = d.decode(_check_against=reference)
+                assert d.channels == header.channels
+                assert (decoded_samples == reference).all()
+
+    def test_other_modes_rejected(self, audio_name="synthetic-mono-tiny"):
+        """Modes a Decoder doesn't list in MODES shouldn't quietly decode
+        some other way, like with a parent class' implementation."""
+        modes = getattr(module.Decoder, "MODES", None)
+        if modes is None:
+            self.skipTest(f"{module.__name__} has no decode modes")
+        d = module.Decoder.from_file(sample_path(audio_name))
+        for mode in {"strict", "lockstep", "fast", "made-up"} - set(modes):
+            with self.subTest(mode=mode):
+                self.assertRaises(AssertionError, d.decode, mode=mode)
+                self.assertRaises(AssertionError, d.decode_range, 0, 5, mode=mode)
+                self.assertRaises(AssertionError, d.read, 5, mode=mode)
+                self.assertRaises(AssertionError, next, d.iter_frames(mode=mode))
+
+    def test_decode_range(self, audio_name=DEFAULT_SAMPLE):
+        """decode_range() should only need the frames it covers."""
+        if not hasattr(module.Decoder, "decode_range"):
+            self.skipTest(f"{module.__name__} has no random access")
+        _, reference = self.load_reference(audio_name)
+        d = module.Decoder.from_file(sample_path(audio_name))
+        d.decode_header()
+        n = len(reference)
+
+        for start, stop in [(0, 1), (5119, 5121), (n // 3, n // 3 + 12345), (n - 7, n + 100)]:
+            with self.subTest(start=start, stop=stop):
+                decoded_samples = d.decode_range(start, stop)
+                assert (decoded_samples == reference[start:stop]).all()
+                assert decoded_samples.shape == reference[start:stop].shape
+
+        d.seek(n - 10000)
+        assert (d.read(6000) == reference[n - 10000:n - 4000]).all()
+        assert (d.read(6000) == reference[n - 4000:]).all()
+        assert d.position == n
+
+    def test_iter_frames(self, audio_name=DEFAULT_SAMPLE, frames=3):
+        """iter_frames() should yield the file one frame at a time."""
+        if not hasattr(module.Decoder, "iter_frames"):
+            self.skipTest(f"{module.__name__} can't iterate over frames")
+        _, reference = self.load_reference(audio_name)
+        d = module.Decoder.from_file(sample_path(audio_name))
+
+        sample_index = 0
+        for _, frame in zip(range(frames), d.iter_frames()):
+            # some implementations also give out their lms state with the samples
+            samples = frame[0] if isinstance(frame, tuple) else frame
+            assert len(samples)
+            assert (samples == reference[sample_index:sample_index + len(samples)]).all()
+            sample_index += len(samples)
+
+if __name__ == "__main__":
     parser = argparse.ArgumentParser(description=__doc__)
-    parser.add_argument("-i", "--implementation",
-                        choices=[m.stem for m in modules.glob("*.py")],
-                        default="python_qoa",
-    )
+    add_implementation_argument(parser)
+    parser.add_argument("--log-level", default="WARNING", help="of the implementations' logging")
+    parser.add_argument("--synthesize", action="store_true",
+                        help="make the synthetic corpus and its golden decodes up front")
     args, unittest_args = parser.parse_known_args(sys.argv)
     if "--" in unittest_args: unittest_args.remove("--")
 
-    sys.path.append(str(modules))
-    module = __import__(args.implementation)
+    logging.basicConfig(format="%(funcName)s() %(message)s", level=args.log_level)
+    module = import_implementation(args.implementation)
 
-    SAMPLES = (pathlib.Path(__file__)/"../../samples/").resolve()
+    if args.synthesize:
+        for audio_name in SYNTHETIC_SAMPLES:
+            golden(sample_path(audio_name))
 
     unittest.main(argv=unittest_args, exit=(not sys.flags.interactive))
@@ -0,0 +1,101 @@
+// Decodes every channel of a frame at once, with a slice_decoder lane
+// (and so an lms) per channel.
+//
+// Slices come in interleaved, in the same order as in the frame, one per
+// clock. They're held until every lane has its next one, then all lanes
+// load together and every clock gives out a sample of every channel.
+// Buffering the next slice of every lane has to fit in the 20 clocks the
+// lanes spend on the current ones, so this keeps up with up to 20
+// channels.
+
+module frame_decoder #(
+	parameter CHANNELS = 2
+) (
+	// lms load interface for decoder, lms_state of every channel goes in
+	// here, 4 values per channel
+	input wire lms_load,
+	input wire signed [15:0] lms_load_history[0:CHANNELS*4-1],
+	input wire signed [15:0] lms_load_weights[0:CHANNELS*4-1],
+
+	// interleaved slice input interface
+	input wire load_slice,
+	input wire[63:0] new_slice_data,
+	output wire slice_ready, // load_slice is ignored unless this is set
+
+	// sample data output, a sample of every channel every clock
+	output wire signed [31:0] samples[0:CHANNELS-1],
+	output wire samples_valid,
+
+	input wire clk, // sample clock
+	input wire rst,
+
+	// allow a view into the internal lms states for the encoder to save them
+	output wire signed [15:0] lms_save_history[0:CHANNELS*4-1],
+	output wire signed [15:0] lms_save_weights[0:CHANNELS*4-1]
+);
+
+reg[63:0] pending[0:CHANNELS-1]; // the next slice of every lane
+reg[$clog2(CHANNELS + 1)-1:0] pending_count;
+
+wire[CHANNELS-1:0] lane_empty;
+wire[CHANNELS-1:0] lane_valid;
+
+// the lanes run in lockstep, so they all run out at the same time
+wire advance = pending_count == CHANNELS && lane_empty[0];
+
+assign slice_ready = pending_count != CHANNELS || advance;
+assign samples_valid = lane_valid[0];
+
+genvar ch, i;
+generate
+	for (ch = 0; ch < CHANNELS; ch++) begin : lane
+		wire signed [15:0] load_history[0:3];
+		wire signed [15:0] load_weights[0:3];
+		wire signed [15:0] save_history[0:3];
+		wire signed [15:0] save_weights[0:3];
+
+		for (i = 0; i < 4; i++) begin : lms_state
+			assign load_history[i] = lms_load_history[ch * 4 + i];
+			assign load_weights[i] = lms_load_weights[ch * 4 + i];
+			assign lms_save_history[ch * 4 + i] = save_history[i];
+			assign lms_save_weights[ch * 4 + i] = save_weights[i];
+		end
+
+		slice_decoder slice_decoder(
+			.lms_load(lms_load),
+			.lms_load_history(load_history),
+			.lms_load_weights(load_weights),
+
+			.load_slice(advance),
+			.new_slice_data(pending[ch]),
+			.slice_empty(lane_empty[ch]),
+
+			.sample(samples[ch]),
+			.sample_valid(lane_valid[ch]),
+
+			.clk(clk),
+			.rst(rst),
+
+			.lms_save_history(save_history),
+			.lms_save_weights(save_weights)
+		);
+	end
+endgenerate
+
+always @ (posedge clk) begin
+	if (advance) begin
+		pending_count <= 0;
+	end
+
+	if (load_slice && slice_ready) begin
+		// the lanes took the pending slices this clock, start over
+		pending[advance ? 0 : pending_count] <= new_slice_data;
+		pending_count <= advance ? 1 : pending_count + 1;
+	end
+
+	if (rst) begin
+		pending_count <= 0;
+	end
+end
+
+endmodule
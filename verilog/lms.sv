@@ -2,17 +2,31 @@
 // using a “Sign-Sign Least Mean Squares Filter“ (LMS). This
 // prediction plus the dequantized residual forms the final output
 // sample.
+//
+// MULTIPLIERS picks how the 4 taps of the prediction are computed:
+// * 4: all at once, combinationally. prediction is always valid, so
+//   there can be an update every clock.
+// * 1 or 2: that many multipliers, accumulating into a register over
+//   the 4 / MULTIPLIERS clocks after every load or update. Less area
+//   and a shorter path, but prediction_valid only comes back after
+//   those clocks, so there can only be an update every
+//   4 / MULTIPLIERS + 1 clocks.
+// Anything else fails at elaboration.
 
-module lms(
+module lms #(
+	parameter MULTIPLIERS = 4
+) (
 	// load interface for decoder, lms_state goes in here
 	input wire load,
 	input wire signed [15:0] load_history[0:3],
 	input wire signed [15:0] load_weights[0:3],
 
-	// async prediction, always available
+	// prediction, only to be used while prediction_valid is set
 	output reg signed [31:0] prediction,
+	output wire prediction_valid,
 
-	// update interface, to be used to advance the sample
+	// update interface, to be used to advance the sample,
+	// only while prediction_valid is set
 	input wire update,
 	input wire signed [31:0] sample,
 	input wire signed [27:0] delta,
@@ -31,23 +45,72 @@ reg signed [15:0] weights[0:3]; // after I figure out how to cast nicely
 always @ * begin
 	save_history = history;
 	save_weights = weights;
+end
 
-	// in spec [4]
-	prediction = 0;
-	for (integer i = 0; i < 4; i++) begin
-		prediction += history[i] * weights[i];
+generate
+	// anything else would leave taps out of the prediction
+	if (MULTIPLIERS != 1 && MULTIPLIERS != 2 && MULTIPLIERS != 4) begin : bad_multipliers
+		$error("lms: MULTIPLIERS has to be 1, 2 or 4, not %0d", MULTIPLIERS);
 	end
-	prediction >>= 13; // TODO: parent needs ugly sign extension, maybe fix it here
-	// TODO: consider sizing prediction port to be smaller since
-	// we're throwing away bits anyway
-end
+
+	if (MULTIPLIERS == 4) begin : parallel
+		assign prediction_valid = 1;
+
+		always @ * begin
+			// in spec [4]
+			prediction = 0;
+			for (integer i = 0; i < 4; i++) begin
+				prediction += history[i] * weights[i];
+			end
+			prediction >>>= 13; // arithmetic, so it stays signed for the parent
+			// TODO: consider sizing prediction port to be smaller since
+			// we're throwing away bits anyway
+		end
+	end else begin : mac
+		localparam STEPS = 4 / MULTIPLIERS;
+
+		reg[2:0] steps_left; // 0 once prediction is done
+		reg signed [31:0] accumulator;
+		reg signed [31:0] products;
+
+		assign prediction_valid = steps_left == 0;
+
+		// in spec [4], MULTIPLIERS taps of it per clock. Once done
+		// (steps_left == 0) the tap index would be past the last one.
+		always @ * begin
+			products = 0;
+			if (steps_left != 0) begin
+				for (integer i = 0; i < MULTIPLIERS; i++) begin
+					products += history[(STEPS - steps_left) * MULTIPLIERS + i]
+						* weights[(STEPS - steps_left) * MULTIPLIERS + i];
+				end
+			end
+		end
+
+		always @ (posedge clk) begin
+			if (steps_left == 1) begin
+				prediction <= (accumulator + products) >>> 13;
+			end
+			if (steps_left != 0) begin
+				accumulator <= accumulator + products;
+				steps_left <= steps_left - 1;
+			end
+
+			// history or weights change, start over
+			if (update || load || rst) begin
+				accumulator <= 0;
+				steps_left <= STEPS;
+			end
+		end
+	end
+endgenerate
 
 always @ (posedge clk) begin
 
 	if (update) begin
 		// use delta to update weights, in spec [6]
 		for (integer i = 0; i < 4; i++) begin
-			weights[i] += history[i] < 0 ? -delta : delta;
+			weights[i] <= weights[i] + (history[i] < 0 ? -delta : delta);
 		end
 
 		// append sample to history, in spec [7]
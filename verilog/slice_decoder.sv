@@ -1,3 +1,12 @@
+// Decodes a slice, one sample per clock. A slice is 64 bits: a 4 bit
+// scalefactor followed by 20 3 bit quantized residuals. Every clock the
+// next residual is dequantized, added to the lms prediction and clamped
+// into a sample, which also updates the lms for the next one.
+//
+// Loading a slice takes a clock, after that slice_empty goes up for the
+// last residual so the next slice can be loaded in the same clock and
+// samples keep coming without a gap.
+
 module slice_decoder(
 	// lms load interface for decoder, lms_state goes in here
 	input wire lms_load,
@@ -10,28 +19,88 @@ module slice_decoder(
 	output wire slice_empty, // if set next clk must do a new load_slice
 
 	// sample data output
-	output wire signed [31:0] sample,
+	output reg signed [31:0] sample,
+	output wire sample_valid, // sample is one of the slice's, not filler
 
 	input wire clk, // sample clock
 	input wire rst,
 
 	// allow a view into the internal lms state for the encoder to save them
-	output reg signed [15:0] lms_save_history[0:3],
-	output reg signed [15:0] lms_save_weights[0:3]
+	output wire signed [15:0] lms_save_history[0:3],
+	output wire signed [15:0] lms_save_weights[0:3]
 );
-reg[63:0] slice_data;
 
-always @ * begin
+// qoa_dequant_tab[16][8] from qoa.h, indexed by {scalefactor, quantized}
+localparam logic signed [15:0] DEQUANT_TAB[0:127] = '{
+	     1,     -1,      3,     -3,      5,     -5,      7,     -7,
+	     5,     -5,     18,    -18,     32,    -32,     49,    -49,
+	    16,    -16,     53,    -53,     95,    -95,    147,   -147,
+	    34,    -34,    113,   -113,    203,   -203,    315,   -315,
+	    63,    -63,    210,   -210,    378,   -378,    588,   -588,
+	   104,   -104,    345,   -345,    621,   -621,    966,   -966,
+	   158,   -158,    528,   -528,    950,   -950,   1477,  -1477,
+	   228,   -228,    760,   -760,   1368,  -1368,   2128,  -2128,
+	   316,   -316,   1053,  -1053,   1895,  -1895,   2947,  -2947,
+	   422,   -422,   1405,  -1405,   2529,  -2529,   3934,  -3934,
+	   548,   -548,   1828,  -1828,   3290,  -3290,   5117,  -5117,
+	   696,   -696,   2320,  -2320,   4176,  -4176,   6496,  -6496,
+	   868,   -868,   2893,  -2893,   5207,  -5207,   8099,  -8099,
+	  1064,  -1064,   3548,  -3548,   6386,  -6386,   9933,  -9933,
+	  1286,  -1286,   4288,  -4288,   7718,  -7718,  12005, -12005,
+	  1536,  -1536,   5120,  -5120,   9216,  -9216,  14336, -14336
+};
+
+reg[3:0] scalefactor;
+reg[59:0] residuals; // the ones left to decode, the next one on top
+reg[4:0] remaining; // how many residuals are left in the slice
+
+wire signed [15:0] dequantized = DEQUANT_TAB[{scalefactor, residuals[59:57]}]; // in spec [3]
+wire signed [31:0] prediction;
 
+assign sample_valid = remaining != 0;
+assign slice_empty = remaining <= 1;
+
+always @ * begin
+	// in spec [5]
+	sample = prediction + dequantized;
+	if (sample > 32767)
+		sample = 32767;
+	else if (sample < -32768)
+		sample = -32768;
 end
 
+lms lms(
+	.load(lms_load),
+	.load_history(lms_load_history),
+	.load_weights(lms_load_weights),
+
+	.prediction(prediction),
+
+	.update(sample_valid),
+	.sample(sample),
+	.delta(dequantized >>> 4),
+
+	.clk(clk),
+	.rst(rst),
+
+	.save_history(lms_save_history),
+	.save_weights(lms_save_weights)
+);
+
 always @ (posedge clk) begin
-	if (load_slice) begin
+	if (sample_valid) begin
+		residuals <= residuals << 3;
+		remaining <= remaining - 1;
+	end
 
+	if (load_slice) begin
+		scalefactor <= new_slice_data[63:60];
+		residuals <= new_slice_data[59:0];
+		remaining <= 20;
 	end
 
 	if (rst) begin
-
+		remaining <= 0;
 	end
 end
 